@@ -4,10 +4,144 @@
 ***********************************************************************************************************************
 """
 
+import argparse
 import datetime
+import importlib
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from urllib3.util.retry import Retry
 from prometheus_api_client import PrometheusConnect, PrometheusApiClientException
-from pandas import DataFrame
+from pandas import DataFrame, concat
+import numpy as np
 import os.path
+import sqlite3
+from series_registry import SeriesRegistry
+
+"""
+***********************************************************************************************************************
+    Fetch Manifest Class
+***********************************************************************************************************************
+"""
+
+
+class FetchManifest:
+    """
+    Small sqlite file that remembers the state of every (metric, window) that was fetched.
+    """
+    FETCHED = "fetched"
+    EMPTY = "empty"
+    FAILED = "failed"
+
+    def __init__(self, path_to_manifest: str):
+        self.path_to_manifest = path_to_manifest
+        os.makedirs(os.path.dirname(path_to_manifest), exist_ok=True)
+        # the workers of the fetcher record their windows concurrently
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path_to_manifest, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS windows (
+                    metric TEXT NOT NULL,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    row_count INTEGER,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (metric, start_time)
+                )
+            """)
+
+    def record(self, metric: str, start_time: datetime.datetime, end_time: datetime.datetime, status: str,
+               row_count=None):
+        assert status in [FetchManifest.FETCHED, FetchManifest.EMPTY, FetchManifest.FAILED]
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)",
+                (metric, str(start_time), str(end_time), status, row_count, str(datetime.datetime.now()))
+            )
+
+    def record_existing_files(self, metric: str, directory_path: str, file_extension: str):
+        "windows that were fetched before the manifest existed are only known from the files on disk"
+        if not os.path.isdir(directory_path):
+            return
+        with self.lock, self.connection:
+            for file_name in os.listdir(directory_path):
+                if not file_name.endswith(file_extension):
+                    continue
+                file_name_without_extension = os.path.splitext(file_name)[0]
+                start_time = datetime.datetime.strptime(file_name_without_extension[:19], "%Y-%m-%d_%H_%M_%S")
+                end_time = datetime.datetime.strptime(file_name_without_extension[-19:], "%Y-%m-%d_%H_%M_%S")
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO windows VALUES (?, ?, ?, ?, ?, ?)",
+                    (metric, str(start_time), str(end_time), FetchManifest.FETCHED, None,
+                     str(datetime.datetime.now()))
+                )
+
+    def get_completed_start_times(self, metric: str):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start_time FROM windows WHERE metric = ? AND status IN (?, ?)",
+                (metric, FetchManifest.FETCHED, FetchManifest.EMPTY)
+            ).fetchall()
+        return {datetime.datetime.fromisoformat(row[0]) for row in rows}
+
+    def get_failed_start_times(self, metric: str):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start_time FROM windows WHERE metric = ? AND status = ?",
+                (metric, FetchManifest.FAILED)
+            ).fetchall()
+        return {datetime.datetime.fromisoformat(row[0]) for row in rows}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+"""
+***********************************************************************************************************************
+    Circuit Breaker Class
+***********************************************************************************************************************
+"""
+
+
+class CircuitBreaker:
+    """
+    Shared by all the workers of the fetcher. After failure_threshold overload failures in a row the breaker opens
+    and every worker pauses for cooldown_in_seconds before sending another request.
+    """
+    def __init__(self, failure_threshold: int = 5, cooldown_in_seconds: float = 60):
+        self.failure_threshold = failure_threshold
+        self.cooldown_in_seconds = cooldown_in_seconds
+        self.lock = threading.Lock()
+        self.number_of_consecutive_failures = 0
+        self.open_until = 0.0
+
+    def wait_until_closed(self):
+        while True:
+            with self.lock:
+                seconds_to_wait = self.open_until - time.time()
+            if seconds_to_wait <= 0:
+                return
+            time.sleep(seconds_to_wait)
+
+    def record_success(self):
+        with self.lock:
+            self.number_of_consecutive_failures = 0
+
+    def record_overload(self):
+        with self.lock:
+            self.number_of_consecutive_failures += 1
+            if self.number_of_consecutive_failures >= self.failure_threshold:
+                print(f"Endpoint looks overloaded, pausing all requests for {self.cooldown_in_seconds} seconds")
+                self.open_until = time.time() + self.cooldown_in_seconds
+                # one more failure after the pause opens the breaker again
+                self.number_of_consecutive_failures = self.failure_threshold - 1
+
 
 """
 ***********************************************************************************************************************
@@ -20,15 +154,53 @@ class DataFetcher:
     """
     Class that can fetch data from prometheus in operate first.
     """
-    def __init__(self, access_token, url_to_fetch_from):
+    def __init__(self, access_token, url_to_fetch_from, max_requests_in_flight: int = 1, hours_per_query: int = 1,
+                 output_format: str = "csv", series_registry: SeriesRegistry = None,
+                 path_to_data: str = "../data/step_1__continuous_data_fetching", number_of_hours_to_fetch: int = 24 * 10,
+                 streaming: bool = False, max_attempts_per_request: int = 5, request_timeout_in_seconds: float = 300,
+                 circuit_breaker: CircuitBreaker = None, window_consumer=None, save_windows: bool = True,
+                 should_stop=None):
+        assert max_requests_in_flight >= 1
+        assert hours_per_query >= 1
+        assert max_attempts_per_request >= 1
+        assert output_format in ["csv", "parquet"]
         self.access_token = access_token
         self.url_to_fetch_from = url_to_fetch_from
+        self.max_requests_in_flight = max_requests_in_flight
+        # bigger ranges are split in half automatically when the server refuses them
+        self.hours_per_query = hours_per_query
+        # parquet keeps the values as float32 and the labels dictionary encoded
+        self.output_format = output_format
+        # when a registry is given the files hold a series_id column instead of the label columns
+        self.series_registry = series_registry
+        self.path_to_data = path_to_data
+        self.number_of_hours_to_fetch = number_of_hours_to_fetch
+        # parse responses incrementally (requires ijson), memory is then bounded by one series instead of one response
+        self.streaming = streaming
+        # transient failures are retried per request with exponential backoff, see __run_with_retries
+        self.max_attempts_per_request = max_attempts_per_request
+        self.request_timeout_in_seconds = request_timeout_in_seconds
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        # called with (metric, start time, end time, data frame of the hour or None) of every window from the workers,
+        # see run_pipeline.py. Without save_windows the hourly files are not written and the consumer is the only output
+        self.window_consumer = window_consumer
+        self.save_windows = save_windows
+        # called before every query, once it returns True no more queries are sent, see run_pipeline.py
+        self.should_stop = should_stop
         self.prometheus_connection = None
+        # every worker thread keeps its own keep-alive session, see __get_connection_of_current_worker
+        self.worker_local_storage = threading.local()
+        self.all_worker_connections = []
+        self.all_worker_connections_lock = threading.Lock()
         self.metrics = [
             "node_memory_active_bytes_percentage",
             "container_memory_working_set_bytes",
             "container_cpu_usage_seconds"
         ]
+        self.manifest = FetchManifest(f"{path_to_data}/fetch_manifest.sqlite")
+        # counters that are used for measuring the fetcher, see benchmark_fetch.py
+        self.statistics = {"queries": 0, "windows_written": 0, "conversion_seconds": 0.0}
+        self.statistics_lock = threading.Lock()
 
     """
     *******************************************************************************************************************
@@ -41,80 +213,111 @@ class DataFetcher:
         return str(date_time).replace(":", "_").replace(" ", "_")
 
     @staticmethod
-    def __get_string_from_timestamp(time_stamp):
-        def __convert_timestamp_to_datetime(time_stamp):
-            return datetime.datetime.fromtimestamp(time_stamp)
-
-        return DataFetcher.__convert_datetime_to_string(__convert_timestamp_to_datetime(time_stamp))
-
-    @staticmethod
-    def __prepare_dictionary_to_house_query_result(data, start_time: datetime.datetime, end_time: datetime.datetime,
-                                                   step: int):
-        assert data is not None
-        final_result_as_dict = {}
-
-        #  allocate headers
-        metric_dictionary_keys = data[0]['metric'].keys()
-        for key in metric_dictionary_keys:
-            final_result_as_dict[key] = []
-
+    def __get_time_stamps_of_range(start_time: datetime.datetime, end_time: datetime.datetime, step: int):
         current_time = start_time
         time_stamps = []
         while current_time <= end_time:
-            time_stamps.append(DataFetcher.__convert_datetime_to_string(current_time))
+            time_stamps.append(current_time)
             current_time += datetime.timedelta(seconds=step)
-        assert len(time_stamps) == 61
-
-        for key in time_stamps:
-            final_result_as_dict[key] = []
-
-        return final_result_as_dict, metric_dictionary_keys, time_stamps
+        return time_stamps
 
     @staticmethod
-    def __insert_data_query_result_into_dictionary(final_result_as_dict, metric_dictionary_keys,
-                                                   time_stamps, data):
-        length = 0  # this will ne used for checking legality
-        # for each container, put the data in the dictionary
+    def __convert_query_result_to_data_frame(data, start_time: datetime.datetime, end_time: datetime.datetime,
+                                             step: int, series_registry: SeriesRegistry = None) -> DataFrame:
+        assert data is not None
+        time_stamps = DataFetcher.__get_time_stamps_of_range(start_time=start_time, end_time=end_time, step=step)
+
+        #  allocate headers
+        metric_dictionary_keys = data[0]['metric'].keys()
         for container in data:
             assert container['metric'].keys() == metric_dictionary_keys
-            for key, value in container['metric'].items():
-                final_result_as_dict[key].append(value)
-
-            # fill time slots
-            for tv in container['values']:
-                final_result_as_dict[DataFetcher.__get_string_from_timestamp(tv[0])].append(tv[1])
 
-            # fill remaining time slots wit None
-            # go over all the minutes in the hour
-            for time in time_stamps:
-                # if there is no value for this minute put in None.
-                if time not in [DataFetcher.__get_string_from_timestamp(tv[0]) for tv in container['values']]:
-                    final_result_as_dict[time].append(None)
-
-            length += 1
-            for key, value in final_result_as_dict.items():
-                assert length == len(value)
-        assert length == len(data)
-        assert len(final_result_as_dict) == 61 + len(metric_dictionary_keys)
-
-        return DataFrame(final_result_as_dict)
+        # turn every sample of every container into (row, column offset, value) in one go
+        number_of_samples_of_each_container = [len(container['values']) for container in data]
+        samples = np.array(
+            [tv for container in data for tv in container['values']],
+            dtype=np.float64
+        ).reshape(-1, 2)
+        rows = np.repeat(np.arange(len(data)), number_of_samples_of_each_container)
+        columns = np.rint((samples[:, 0] - start_time.timestamp()) / step).astype(np.int64)
+        is_in_range = (0 <= columns) & (columns < len(time_stamps))
+
+        # minutes that have no value stay NaN
+        values = np.full((len(data), len(time_stamps)), np.nan, dtype=np.float64)
+        values[rows[is_in_range], columns[is_in_range]] = samples[is_in_range, 1]
+
+        return DataFetcher.__get_data_frame_of_labels_and_values(
+            list_of_labels=[container['metric'] for container in data],
+            values=values,
+            time_stamps=time_stamps,
+            series_registry=series_registry
+        )
 
     @staticmethod
-    def __convert_query_result_to_data_frame(data, start_time: datetime.datetime, end_time: datetime.datetime,
-                                             step: int) -> DataFrame:
-        assert data is not None
-        a, b, c = DataFetcher.__prepare_dictionary_to_house_query_result(
-            data=data,
-            start_time=start_time,
-            end_time=end_time,
-            step=step
+    def __get_data_frame_of_labels_and_values(list_of_labels, values: np.ndarray, time_stamps,
+                                              series_registry: SeriesRegistry) -> DataFrame:
+        if series_registry is not None:
+            # rows are kept in series id order, the labels are resolved again only when exporting
+            series_ids = series_registry.get_series_ids(list_of_labels)
+            order = np.argsort(series_ids, kind="stable")
+            labels_df = DataFrame({SeriesRegistry.SERIES_ID_COLUMN: series_ids[order]})
+            values = values[order]
+        else:
+            labels_df = DataFrame(list_of_labels)
+
+        return concat(
+            [
+                labels_df,
+                DataFrame(values, columns=[DataFetcher.__convert_datetime_to_string(t) for t in time_stamps])
+            ],
+            axis=1
+        )
+
+    def __get_query_result_as_data_frame_streaming(self, query: str, start_time: datetime.datetime,
+                                                   end_time: datetime.datetime, step: int):
+        "the response is parsed incrementally so only one series is held as python objects at any time"
+        import ijson  # only needed for streaming
+        time_stamps = self.__get_time_stamps_of_range(start_time=start_time, end_time=end_time, step=step)
+        prometheus_connection = self.__get_connection_of_current_worker()
+        response = self.worker_local_storage.session.get(
+            url=f"{self.url_to_fetch_from}/api/v1/query_range",
+            params={
+                "query": query,
+                "start": round(start_time.timestamp()),
+                "end": round(end_time.timestamp()),
+                "step": str(step)
+            },
+            headers=prometheus_connection.headers,
+            stream=True,
+            timeout=self.request_timeout_in_seconds
         )
-        final_result_as_dict, metric_dictionary_keys, time_stamps = (a, b, c)
-        return DataFetcher.__insert_data_query_result_into_dictionary(
-            data=data,
-            final_result_as_dict=final_result_as_dict,
-            metric_dictionary_keys=metric_dictionary_keys,
-            time_stamps=time_stamps
+        with response:
+            if response.status_code != 200:
+                # same message as prometheus_api_client so that errors are handled the same way
+                raise PrometheusApiClientException(
+                    "HTTP Status Code {} ({!r})".format(response.status_code, response.content)
+                )
+            response.raw.decode_content = True
+            list_of_labels = []
+            values = np.full((1024, len(time_stamps)), np.nan, dtype=np.float64)
+            for container in ijson.items(response.raw, "data.result.item", use_float=True):
+                row = len(list_of_labels)
+                if row == values.shape[0]:
+                    values = np.concatenate([values, np.full_like(values, np.nan)])
+                samples = np.array(container['values'], dtype=np.float64).reshape(-1, 2)
+                columns = np.rint((samples[:, 0] - start_time.timestamp()) / step).astype(np.int64)
+                is_in_range = (0 <= columns) & (columns < len(time_stamps))
+                values[row, columns[is_in_range]] = samples[is_in_range, 1]
+                list_of_labels.append(container['metric'])
+
+        if not list_of_labels:
+            return None
+        assert all(labels.keys() == list_of_labels[0].keys() for labels in list_of_labels)
+        return self.__get_data_frame_of_labels_and_values(
+            list_of_labels=list_of_labels,
+            values=values[:len(list_of_labels)],
+            time_stamps=time_stamps,
+            series_registry=self.series_registry
         )
 
     def __convert_metric_to_query(self, metric: str) -> str:
@@ -130,33 +333,320 @@ class DataFetcher:
             assert False
         return result
 
-    def __get_data_in_certain_range(self, start_time, end_time, query: str, csv_path: str):
-        print("getting data for ", start_time, " to ", end_time)
-        metric_df = None
-        if os.path.exists(csv_path):
-            print("Data already exists, moving on!")
+    def __create_prometheus_connection(self, session: requests.Session):
+        prometheus_connection = PrometheusConnect(
+            url=self.url_to_fetch_from,
+            headers={"Authorization": f"Bearer {self.access_token}"},
+            disable_ssl=False,
+            session=session,
+            # retrying is done by __run_with_retries, not silently inside the http adapter
+            retry=Retry(total=0, status_forcelist=[], raise_on_status=False),
+            timeout=self.request_timeout_in_seconds
+        )
+        with self.all_worker_connections_lock:
+            self.all_worker_connections.append(prometheus_connection)
+        return prometheus_connection
+
+    def __get_connection_of_current_worker(self):
+        "each thread reuses one pooled keep-alive connection instead of reconnecting for every window"
+        prometheus_connection = getattr(self.worker_local_storage, "prometheus_connection", None)
+        if prometheus_connection is None:
+            session = requests.Session()
+            prometheus_connection = self.__create_prometheus_connection(session=session)
+            self.worker_local_storage.prometheus_connection = prometheus_connection
+            self.worker_local_storage.session = session
+        return prometheus_connection
+
+    @staticmethod
+    def __save_data_frame_as_parquet(data_frame: DataFrame, path: str, number_of_label_columns: int):
+        label_columns = list(data_frame.columns[:number_of_label_columns])
+
+        def __get_type_of_column(column):
+            if column == SeriesRegistry.SERIES_ID_COLUMN:
+                return np.int64
+            return "category" if column in label_columns else np.float32
+
+        data_frame = data_frame.astype({column: __get_type_of_column(column) for column in data_frame.columns})
+        data_frame.to_parquet(path, engine="pyarrow", index=False)
+
+    @staticmethod
+    def __save_data_frame_atomically(data_frame: DataFrame, data_path: str, number_of_label_columns: int):
+        "write to a temporary file first so that a crash never leaves a half written file behind"
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        temporary_path = f"{data_path}.{threading.get_ident()}.tmp"
+        try:
+            if data_path.endswith(".parquet"):
+                DataFetcher.__save_data_frame_as_parquet(
+                    data_frame=data_frame,
+                    path=temporary_path,
+                    number_of_label_columns=number_of_label_columns
+                )
+            else:
+                data_frame.to_csv(temporary_path)
+            os.replace(temporary_path, data_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def __get_directory_of_metric(self, metric: str) -> str:
+        return f'{self.path_to_data}/{metric}'
+
+    def __get_data_path(self, metric: str, start_time: datetime.datetime, end_time: datetime.datetime) -> str:
+        file_name = f'{start_time}_to_{end_time}.{self.output_format}'.replace(":", "_").replace(" ", "_")
+        return f'{self.__get_directory_of_metric(metric)}/{file_name}'
+
+    def __add_to_statistics(self, **amounts):
+        with self.statistics_lock:
+            for name, amount in amounts.items():
+                self.statistics[name] += amount
+
+    @staticmethod
+    def __get_hours_in_range(start_time: datetime.datetime, end_time: datetime.datetime):
+        hours = []
+        _start_time = start_time
+        while _start_time < end_time:
+            hours.append((_start_time, _start_time + datetime.timedelta(hours=1)))
+            _start_time += datetime.timedelta(hours=1)
+        return hours
+
+    @staticmethod
+    def __is_response_too_large_error(exception: Exception) -> bool:
+        if not isinstance(exception, PrometheusApiClientException):
+            return False
+        message = str(exception).lower()
+        hints = ["too many", "too large", "larger than", "exceeded maximum resolution", "http status code 413"]
+        return any(hint in message for hint in hints)
+
+    @staticmethod
+    def __get_hour_out_of_range_data_frame(range_df: DataFrame, start_time: datetime.datetime,
+                                           end_time: datetime.datetime, number_of_label_columns: int):
+        label_columns = list(range_df.columns[:number_of_label_columns])
+        time_stamp_columns = []
+        current_time = start_time
+        while current_time <= end_time:
+            time_stamp_columns.append(DataFetcher.__convert_datetime_to_string(current_time))
+            current_time += datetime.timedelta(minutes=1)
+        hour_df = range_df[label_columns + time_stamp_columns]
+        # an hourly query would only have returned the containers that have samples in that hour
+        hour_df = hour_df[hour_df[time_stamp_columns].notna().any(axis=1)]
+        return hour_df.reset_index(drop=True)
+
+    @staticmethod
+    def __get_kind_of_transient_error(exception: Exception):
+        "returns None for errors that would fail again, like a bad query or a response that is too large"
+        if isinstance(exception, requests.Timeout):
+            return "timeout"
+        if isinstance(exception, requests.ConnectionError):
+            return "connection error"
+        if isinstance(exception, PrometheusApiClientException):
+            match = re.match(r"HTTP Status Code (\d+)", str(exception))
+            status_code = int(match.group(1)) if match else None
+            if status_code == 429:
+                return "rate limited"
+            if status_code is not None and 500 <= status_code < 600:
+                return "server error"
+        return None
+
+    def __is_stopped(self) -> bool:
+        return self.should_stop is not None and self.should_stop()
+
+    def __raise_if_stopped(self):
+        "the windows that are not fetched are not recorded as failed, they are simply missing"
+        if self.__is_stopped():
+            raise RuntimeError("fetching was stopped")
+
+    def __run_with_retries(self, function):
+        base_delay_in_seconds = 1
+        max_delay_in_seconds = 60
+        for attempt_number in range(1, self.max_attempts_per_request + 1):
+            self.circuit_breaker.wait_until_closed()
+            self.__raise_if_stopped()
+            try:
+                result = function()
+            except Exception as e:
+                kind_of_error = self.__get_kind_of_transient_error(e)
+                if kind_of_error is None:
+                    raise
+                if kind_of_error in ["rate limited", "server error", "timeout"]:
+                    self.circuit_breaker.record_overload()
+                if attempt_number == self.max_attempts_per_request:
+                    raise
+                # a rate limited endpoint needs more room than a single failed request
+                factor = 4 if kind_of_error == "rate limited" else 1
+                delay = random.uniform(0, min(max_delay_in_seconds, factor * base_delay_in_seconds * 2 ** attempt_number))
+                print(f"Got {kind_of_error} ({e}), retry number {attempt_number} in {delay:.1f} seconds")
+                time.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                return result
+
+    def __get_range_data_frame(self, query: str, start_time: datetime.datetime, end_time: datetime.datetime,
+                               step: int):
+        "returns None when the query has no results"
+        conversion_start = time.time()
+        if self.streaming:
+            # parsing and converting happen together while the response is being read
+            range_df = self.__get_query_result_as_data_frame_streaming(
+                query=query,
+                start_time=start_time,
+                end_time=end_time,
+                step=step
+            )
         else:
-            step = 60  # seconds
-            print("running query : ", query)
-            metric_data = self.prometheus_connection.custom_query_range(
+            metric_data = self.__get_connection_of_current_worker().custom_query_range(
                 query=query,
                 start_time=start_time,
                 end_time=end_time,
                 step=str(step)
             )
             if not metric_data:
-                print("Got empty results, moving on!")
-            else:
-                metric_df = self.__convert_query_result_to_data_frame(
-                    data=metric_data,
+                return None
+            conversion_start = time.time()
+            range_df = self.__convert_query_result_to_data_frame(
+                data=metric_data,
+                start_time=start_time,
+                end_time=end_time,
+                step=step,
+                series_registry=self.series_registry
+            )
+        self.__add_to_statistics(conversion_seconds=time.time() - conversion_start)
+        return range_df
+
+    def __get_data_in_certain_range(self, metric: str, start_time: datetime.datetime, end_time: datetime.datetime,
+                                    missing_hours):
+        self.__raise_if_stopped()
+        print("getting data for ", start_time, " to ", end_time)
+        hours = self.__get_hours_in_range(start_time=start_time, end_time=end_time)
+        step = 60  # seconds
+        query = self.__convert_metric_to_query(metric)
+        print("running query : ", query)
+        self.__add_to_statistics(queries=1)
+        try:
+            range_df = self.__run_with_retries(
+                lambda: self.__get_range_data_frame(query=query, start_time=start_time, end_time=end_time, step=step)
+            )
+        except PrometheusApiClientException as e:
+            if len(hours) > 1 and self.__is_response_too_large_error(e):
+                print("Response is too large, splitting the range in half and retrying")
+                middle_time = start_time + datetime.timedelta(hours=len(hours) // 2)
+                self.__get_data_in_certain_range(
+                    metric=metric,
                     start_time=start_time,
+                    end_time=middle_time,
+                    missing_hours=[h for h in missing_hours if h[0] < middle_time]
+                )
+                self.__get_data_in_certain_range(
+                    metric=metric,
+                    start_time=middle_time,
                     end_time=end_time,
-                    step=step
+                    missing_hours=[h for h in missing_hours if h[0] >= middle_time]
                 )
-                print("saving csv to file : ", csv_path)
-                os.makedirs(os.path.dirname(csv_path), exist_ok=True)
-                metric_df.to_csv(csv_path)
-        return metric_df
+                return
+            self.__record_failed_hours(metric=metric, hours=missing_hours)
+            raise
+        except Exception:
+            self.__record_failed_hours(metric=metric, hours=missing_hours)
+            raise
+
+        if range_df is None:
+            print("Got empty results, moving on!")
+            for _start_time, _end_time in missing_hours:
+                self.manifest.record(metric, _start_time, _end_time, FetchManifest.EMPTY, row_count=0)
+                self.__give_window_to_consumer(metric, _start_time, _end_time, None)
+            return
+
+        number_of_time_stamps = len(self.__get_time_stamps_of_range(start_time=start_time, end_time=end_time, step=step))
+        number_of_label_columns = range_df.shape[1] - number_of_time_stamps
+        # write the result out in the usual hourly layout so the following steps are unaffected
+        for _start_time, _end_time in missing_hours:
+            hour_df = self.__get_hour_out_of_range_data_frame(
+                range_df=range_df,
+                start_time=_start_time,
+                end_time=_end_time,
+                number_of_label_columns=number_of_label_columns
+            )
+            if len(hour_df) == 0:
+                print("Got empty results for ", _start_time, " to ", _end_time, ", moving on!")
+                self.manifest.record(metric, _start_time, _end_time, FetchManifest.EMPTY, row_count=0)
+                self.__give_window_to_consumer(metric, _start_time, _end_time, None)
+                continue
+            if self.save_windows:
+                data_path = self.__get_data_path(metric=metric, start_time=_start_time, end_time=_end_time)
+                print(f"saving {self.output_format} to file : ", data_path)
+                self.__save_data_frame_atomically(
+                    data_frame=hour_df,
+                    data_path=data_path,
+                    number_of_label_columns=number_of_label_columns
+                )
+                "a window only counts as fetched once its file exists, otherwise the next run fetches it again"
+                self.manifest.record(metric, _start_time, _end_time, FetchManifest.FETCHED, row_count=len(hour_df))
+                self.__add_to_statistics(windows_written=1)
+            self.__give_window_to_consumer(metric, _start_time, _end_time, hour_df)
+
+    def __give_window_to_consumer(self, metric: str, start_time: datetime.datetime, end_time: datetime.datetime,
+                                  hour_df):
+        if self.window_consumer is not None:
+            self.window_consumer(metric, start_time, end_time, hour_df)
+
+    def __record_failed_hours(self, metric: str, hours):
+        for _start_time, _end_time in hours:
+            self.manifest.record(metric, _start_time, _end_time, FetchManifest.FAILED)
+            self.__give_window_to_consumer(metric, _start_time, _end_time, None)
+
+    def __get_all_windows_to_fetch(self):
+        windows = []
+        time_now = datetime.datetime.now()
+        _end_time = time_now.replace(minute=0, second=0, microsecond=0)
+        _start_time = _end_time - datetime.timedelta(hours=1)
+
+        for i in range(self.number_of_hours_to_fetch):  # by default try 10 days back
+            for metric in self.metrics:
+                windows.append((metric, _start_time, _end_time))
+            _end_time = _start_time
+            _start_time = _end_time - datetime.timedelta(hours=1)
+        return windows
+
+    def __get_ranges_to_fetch(self, only_windows_after_last_completed: bool = False):
+        "group the missing hourly windows of each metric into contiguous ranges of at most hours_per_query hours"
+        ranges = []
+        all_windows = self.__get_all_windows_to_fetch()
+        for metric in self.metrics:
+            self.manifest.record_existing_files(
+                metric=metric,
+                directory_path=self.__get_directory_of_metric(metric),
+                file_extension=f".{self.output_format}"
+            )
+            completed_start_times = self.manifest.get_completed_start_times(metric=metric)
+            missing_start_times = sorted(
+                _start_time for _metric, _start_time, _end_time in all_windows
+                if _metric == metric and _start_time not in completed_start_times
+            )
+            if only_windows_after_last_completed and completed_start_times:
+                "a window that failed while a newer one of the same tick succeeded is older than the newest one"
+                last_completed_start_time = max(completed_start_times)
+                failed_start_times = self.manifest.get_failed_start_times(metric=metric)
+                missing_start_times = [
+                    t for t in missing_start_times if t > last_completed_start_time or t in failed_start_times
+                ]
+            range_start_time = None
+            range_end_time = None
+            for _start_time in missing_start_times:
+                is_contiguous = (range_end_time == _start_time)
+                is_full = (range_start_time is not None) and \
+                    (range_end_time - range_start_time >= datetime.timedelta(hours=self.hours_per_query))
+                if range_start_time is not None and (not is_contiguous or is_full):
+                    ranges.append((metric, range_start_time, range_end_time, missing_hours_of_range))
+                    range_start_time = None
+                if range_start_time is None:
+                    range_start_time = _start_time
+                    missing_hours_of_range = []
+                range_end_time = _start_time + datetime.timedelta(hours=1)
+                missing_hours_of_range.append((_start_time, range_end_time))
+            if range_start_time is not None:
+                ranges.append((metric, range_start_time, range_end_time, missing_hours_of_range))
+        # newest data first, like the serial fetcher used to do
+        ranges.sort(key=lambda r: r[1], reverse=True)
+        return ranges
 
     """
     *******************************************************************************************************************
@@ -165,11 +655,7 @@ class DataFetcher:
     """
 
     def create_connection(self):
-        self.prometheus_connection = PrometheusConnect(
-            url=self.url_to_fetch_from,
-            headers={"Authorization": f"Bearer {self.access_token}"},
-            disable_ssl=False
-        )
+        self.prometheus_connection = self.__get_connection_of_current_worker()
         time_now = datetime.datetime.now()
         _end_time = time_now.replace(minute=0, second=0, microsecond=0)
         _start_time = _end_time - datetime.timedelta(hours=1)
@@ -180,30 +666,111 @@ class DataFetcher:
             step=str(60)
         )
 
-    def get_metric_data_for_the_past_number_of_hours(self):
+    def close_connections(self):
+        with self.all_worker_connections_lock:
+            for prometheus_connection in self.all_worker_connections:
+                prometheus_connection.close()
+            self.all_worker_connections = []
+        self.worker_local_storage = threading.local()
+        self.prometheus_connection = None
+
+    def get_windows_of_past_number_of_hours(self):
+        """
+        Returns (metric, start time, end time) of every hourly window of the past number_of_hours_to_fetch hours,
+        fetched or not.
+        """
+        return self.__get_all_windows_to_fetch()
+
+    def get_windows_to_fetch(self, only_windows_after_last_completed: bool = False):
+        """
+        Returns (metric, start time, end time) of every hourly window that get_metric_data_for_the_past_number_of_hours
+        would fetch now.
+        """
+        return [
+            (metric, _start_time, _end_time)
+            for metric, _, _, missing_hours in self.__get_ranges_to_fetch(
+                only_windows_after_last_completed=only_windows_after_last_completed
+            )
+            for _start_time, _end_time in missing_hours
+        ]
+
+    def get_metric_data_for_the_past_number_of_hours(self, only_windows_after_last_completed: bool = False):
+        """
+        Returns True if fetching any window failed, or if should_stop stopped the fetching.
+        With only_windows_after_last_completed only the windows that closed since the newest window in the manifest
+        and the windows that failed before are fetched, older holes that were never tried are left for a full run.
+        """
         did_failure_happen = False
-        time_now = datetime.datetime.now()
-        _end_time = time_now.replace(minute=0, second=0, microsecond=0)
-        _start_time = _end_time - datetime.timedelta(hours=1)
 
-        for i in range(24 * 10):  # try 10 days back
-            print("")
-            for metric in self.metrics:
+        # at most max_requests_in_flight windows are being fetched at the same time
+        with ThreadPoolExecutor(max_workers=self.max_requests_in_flight) as executor:
+            futures = [
+                executor.submit(
+                    self.__get_data_in_certain_range,
+                    metric=metric,
+                    start_time=_start_time,
+                    end_time=_end_time,
+                    missing_hours=missing_hours
+                )
+                for metric, _start_time, _end_time, missing_hours in self.__get_ranges_to_fetch(
+                    only_windows_after_last_completed=only_windows_after_last_completed
+                )
+            ]
+            for future in as_completed(futures):
                 try:
-                    self.__get_data_in_certain_range(
-                        start_time=_start_time,
-                        end_time=_end_time,
-                        query=self.__convert_metric_to_query(metric),
-                        csv_path=f'../data/step_1__continuous_data_fetching/{metric}/{_start_time}_to_{_end_time}.csv'.replace(":", "_").replace(" ", "_")
-                    )
+                    future.result()
                 except Exception as e:
                     print(e)
                     did_failure_happen = True
-            _end_time = _start_time
-            _start_time = _end_time - datetime.timedelta(hours=1)
+                if self.__is_stopped():
+                    "the ranges that did not start are dropped, only the requests in flight are waited for"
+                    print("Fetching was stopped")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    return True
         return did_failure_happen
 
 
+"""
+***********************************************************************************************************************
+    daemon function
+***********************************************************************************************************************
+"""
+
+
+def fetch_continuously(data_fetcher: DataFetcher, interval_in_minutes: float, jitter_in_minutes: float = 1,
+                       max_backoff_in_minutes: float = 30, merge_into_live_segments: bool = True):
+    """
+    Every interval_in_minutes fetch only the windows that closed since the last successful one, and the windows that
+    failed before, and append them to the merged store of step 2. After a failure the next attempt comes sooner,
+    backing off exponentially.
+    """
+    DataMerger = importlib.import_module("02_merge_data").DataMerger
+    number_of_consecutive_failures = 0
+    while True:
+        print(f"Fetching new windows, time = {datetime.datetime.now()}")
+        did_failure_happen = data_fetcher.get_metric_data_for_the_past_number_of_hours(
+            only_windows_after_last_completed=True
+        )
+        if merge_into_live_segments:
+            for metric in data_fetcher.metrics:
+                metric_directory = f"{data_fetcher.path_to_data}/{metric}"
+                if os.path.isdir(metric_directory):
+                    "writing a segment costs as much as its history, that is left for 02_merge_data.py"
+                    DataMerger(metric_directory).append_new_files_to_live_segments(write_segment_files=False)
+
+        if did_failure_happen:
+            number_of_consecutive_failures += 1
+            minutes_to_wait = min(2 ** number_of_consecutive_failures, max_backoff_in_minutes, interval_in_minutes)
+            print(f"Failure number {number_of_consecutive_failures} in a row, backing off.")
+        else:
+            number_of_consecutive_failures = 0
+            minutes_to_wait = interval_in_minutes
+        # jitter keeps many fetchers from hitting the endpoint at the same moment
+        minutes_to_wait += random.uniform(0, jitter_in_minutes)
+        print(f"Sleeping for {minutes_to_wait:.1f} minutes")
+        time.sleep(minutes_to_wait * 60)
+
+
 """
 ***********************************************************************************************************************
     main function
@@ -211,7 +778,40 @@ class DataFetcher:
 """
 
 
+def get_access_token(path_to_token_file: str = None) -> str:
+    """
+    The token is taken from PROMETHEUS_ACCESS_TOKEN, then from a file (PROMETHEUS_ACCESS_TOKEN_FILE),
+    and only then asked for.
+    """
+    if os.environ.get("PROMETHEUS_ACCESS_TOKEN"):
+        return os.environ["PROMETHEUS_ACCESS_TOKEN"].strip()
+    path_to_token_file = path_to_token_file or os.environ.get("PROMETHEUS_ACCESS_TOKEN_FILE")
+    if path_to_token_file:
+        with open(path_to_token_file) as token_file:
+            return token_file.read().strip()
+    return input("Inter access token:")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Fetch data from prometheus in operate first.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and fetch only the newest windows every --interval minutes")
+    parser.add_argument("--interval", type=float, default=60, help="minutes between two fetches in daemon mode")
+    parser.add_argument("--token-file", default=None, help="file that contains the access token")
+    parser.add_argument("--hours", type=int, default=24 * 10, help="number of hours to fetch backwards")
+    parser.add_argument("--max-requests-in-flight", type=int, default=8)
+    parser.add_argument("--hours-per-query", type=int, default=6,
+                        help="hours of one query, ranges that the server refuses are split in half")
+    parser.add_argument("--output-format", choices=["csv", "parquet"], default="csv",
+                        help="parquet keeps the values as float32 and the labels dictionary encoded")
+    parser.add_argument("--streaming", action="store_true",
+                        help="parse the responses incrementally (requires ijson), "
+                             "memory is then bounded by one series instead of one response")
+    parser.add_argument("--series-registry", default=None,
+                        help="registry file, e.g. ../data/series_registry.csv, the hourly files then hold a series_id "
+                             "column instead of the label columns")
+    arguments = parser.parse_args()
+
     print("""
     Thank you for using our tool. Let's get some data.
     You can get an access token here :
@@ -220,18 +820,34 @@ def main():
     https://oauth-openshift.apps.smaug.na.operate-first.cloud/oauth/token/request
     """)
 
-    access_token = input("Inter access token:")
+    access_token = get_access_token(path_to_token_file=arguments.token_file)
     url_to_fetch_from = "https://thanos-query-frontend-opf-observatorium.apps.smaug.na.operate-first.cloud"
     data_fetcher = DataFetcher(
         access_token=access_token,
-        url_to_fetch_from=url_to_fetch_from
+        url_to_fetch_from=url_to_fetch_from,
+        max_requests_in_flight=arguments.max_requests_in_flight,
+        hours_per_query=arguments.hours_per_query,
+        output_format=arguments.output_format,
+        series_registry=None if arguments.series_registry is None else SeriesRegistry(arguments.series_registry),
+        number_of_hours_to_fetch=arguments.hours,
+        streaming=arguments.streaming
     )
 
     print(f"Connecting to url = {url_to_fetch_from}")
     data_fetcher.create_connection()
     print("Connection Successful!")
 
-    number_of_retries = 10
+    if arguments.daemon:
+        try:
+            fetch_continuously(data_fetcher=data_fetcher, interval_in_minutes=arguments.interval)
+        finally:
+            data_fetcher.close_connections()
+            data_fetcher.manifest.close()
+        return
+
+    # transient errors are already retried per request, every attempt here only fetches
+    # the windows that the manifest does not have yet
+    number_of_retries = 3
     for attempt_number in range(1, number_of_retries + 1):
         did_failure_happen = data_fetcher.get_metric_data_for_the_past_number_of_hours()
         if did_failure_happen:
@@ -241,6 +857,8 @@ def main():
         else:
             print("done fetching, exiting")
             break
+    data_fetcher.close_connections()
+    data_fetcher.manifest.close()
 
 
 """
@@ -4,11 +4,210 @@
 ***********************************************************************************************************************
 """
 
+import argparse
+import csv
+import json
 import pandas
+import numpy
 from os import listdir
 from os.path import isfile, join
 import time
 import os
+import datetime
+import re
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from series_registry import SeriesRegistry
+from build_cache import BuildCache
+
+"""
+***********************************************************************************************************************
+    Memory Budget Class
+***********************************************************************************************************************
+"""
+
+
+class MemoryBudget:
+    """
+    Limits how many merges run at the same time by the memory they are estimated to need.
+    One merge is always allowed to run, even if it alone is estimated to need more than the whole budget.
+    """
+    def __init__(self, limit_in_bytes: int):
+        self.limit_in_bytes = limit_in_bytes
+        self.bytes_in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, number_of_bytes: int):
+        with self.condition:
+            while self.bytes_in_use > 0 and self.bytes_in_use + number_of_bytes > self.limit_in_bytes:
+                self.condition.wait()
+            self.bytes_in_use += number_of_bytes
+
+    def release(self, number_of_bytes: int):
+        with self.condition:
+            self.bytes_in_use -= number_of_bytes
+            self.condition.notify_all()
+
+"""
+***********************************************************************************************************************
+    Series Index Class
+***********************************************************************************************************************
+"""
+
+
+class SeriesIndex:
+    """
+    Hash index from the labels of a series to its row. Every label tuple is hashed once,
+    rows never move and series that were not seen before are appended at the end.
+    Labels that only some hours have are added as columns, the series that do not have them get None.
+    """
+    def __init__(self, label_columns):
+        self.label_columns = list(label_columns)
+        self.row_of_labels = {}
+        self.labels_of_rows = []
+
+    def __len__(self):
+        return len(self.labels_of_rows)
+
+    @staticmethod
+    def get_label_tuples(labels_df):
+        "missing labels become None so that equal label sets are equal tuples"
+        labels_df = labels_df.astype(object)
+        labels_df = labels_df.where(labels_df.notna(), None)
+        return list(labels_df.itertuples(index=False, name=None))
+
+    def add_label_columns(self, label_columns):
+        new_label_columns = [column for column in label_columns if column not in self.label_columns]
+        if not new_label_columns:
+            return
+        self.label_columns += new_label_columns
+        self.labels_of_rows = [label_tuple + (None,) * len(new_label_columns) for label_tuple in self.labels_of_rows]
+        self.row_of_labels = {label_tuple: row for row, label_tuple in enumerate(self.labels_of_rows)}
+
+    def get_rows(self, labels_df) -> numpy.ndarray:
+        """
+        Returns the row of every series in labels_df, adding the series that are new.
+        The columns of labels_df may be in any order, and may lack or add label columns.
+        """
+        self.add_label_columns(labels_df.columns)
+        return self.get_rows_of_label_tuples(self.get_label_tuples(labels_df.reindex(columns=self.label_columns)))
+
+    def get_rows_of_label_tuples(self, label_tuples) -> numpy.ndarray:
+        rows = numpy.empty(len(label_tuples), dtype=numpy.int64)
+        for i, label_tuple in enumerate(label_tuples):
+            row = self.row_of_labels.get(label_tuple)
+            if row is None:
+                row = len(self.labels_of_rows)
+                self.row_of_labels[label_tuple] = row
+                self.labels_of_rows.append(label_tuple)
+            rows[i] = row
+        return rows
+
+    def get_labels_data_frame(self, rows=None):
+        labels_of_rows = self.labels_of_rows if rows is None else [self.labels_of_rows[row] for row in rows]
+        return pandas.DataFrame(labels_of_rows, columns=self.label_columns)
+
+
+"""
+***********************************************************************************************************************
+    Merged Store Class
+***********************************************************************************************************************
+"""
+
+
+class MergedStore:
+    """
+    Append only store of the hourly files of one metric that were already merged.
+    Every consumed file becomes one block (rows in the series index and its values) at the end of blocks.bin,
+    blocks.csv records which files were consumed and where their block is, labels.jsonl holds the series index.
+    Adding a file only appends to these three files, so its cost does not depend on the history in the store.
+    """
+    def __init__(self, path_to_store: str):
+        self.path_to_store = path_to_store
+        self.path_to_blocks = f"{path_to_store}/blocks.bin"
+        self.path_to_block_table = f"{path_to_store}/blocks.csv"
+        self.path_to_labels = f"{path_to_store}/labels.jsonl"
+        # csv name -> (offset, number of rows, number of columns, time stamp columns)
+        self.blocks = {}
+        self.series_index = None
+        os.makedirs(path_to_store, exist_ok=True)
+        if os.path.exists(self.path_to_labels):
+            self.__load()
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    def __load(self):
+        with open(self.path_to_labels) as labels_file:
+            self.series_index = SeriesIndex(json.loads(labels_file.readline()))
+            self.series_index.get_rows_of_label_tuples([tuple(json.loads(line)) for line in labels_file])
+        if os.path.exists(self.path_to_block_table):
+            with open(self.path_to_block_table, newline="") as block_table_file:
+                for csv_name, offset, number_of_rows, number_of_columns, time_stamps in csv.reader(block_table_file):
+                    self.blocks[csv_name] = (int(offset), int(number_of_rows), int(number_of_columns), time_stamps.split())
+
+    def __append_new_labels(self, number_of_rows_before):
+        "the labels are written before the block that refers to them"
+        with open(self.path_to_labels, "a") as labels_file:
+            if number_of_rows_before == 0:
+                labels_file.write(json.dumps(self.series_index.label_columns) + "\n")
+            labels_file.write("".join(
+                json.dumps(list(label_tuple)) + "\n"
+                for label_tuple in self.series_index.labels_of_rows[number_of_rows_before:]
+            ))
+
+    def __rewrite_labels(self):
+        "a label that the earlier files did not have changes every line, this is the only time the file is rewritten"
+        with open(f"{self.path_to_labels}.tmp", "w") as labels_file:
+            labels_file.write(json.dumps(self.series_index.label_columns) + "\n")
+            labels_file.write("".join(
+                json.dumps(list(label_tuple)) + "\n" for label_tuple in self.series_index.labels_of_rows
+            ))
+        os.replace(f"{self.path_to_labels}.tmp", self.path_to_labels)
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def get_consumed_file_names(self):
+        return sorted(self.blocks.keys())
+
+    def append(self, csv_name: str, data_frame, label_columns):
+        """
+        Adds the hourly file csv_name to the store, a file is recorded as consumed only after its block was written.
+        """
+        assert csv_name not in self.blocks
+        if self.series_index is None:
+            self.series_index = SeriesIndex(label_columns)
+        number_of_rows_before = len(self.series_index)
+        number_of_label_columns_before = len(self.series_index.label_columns)
+        rows = self.series_index.get_rows(data_frame[label_columns])
+        value_columns = [column for column in data_frame.columns if column not in label_columns]
+        values = numpy.ascontiguousarray(data_frame[value_columns].to_numpy(dtype=numpy.float64))
+        if number_of_rows_before > 0 and len(self.series_index.label_columns) > number_of_label_columns_before:
+            self.__rewrite_labels()
+        elif len(self.series_index) > number_of_rows_before or number_of_rows_before == 0:
+            self.__append_new_labels(number_of_rows_before)
+        with open(self.path_to_blocks, "ab") as blocks_file:
+            offset = blocks_file.seek(0, os.SEEK_END)
+            blocks_file.write(rows.tobytes())
+            blocks_file.write(values.tobytes())
+        with open(self.path_to_block_table, "a", newline="") as block_table_file:
+            csv.writer(block_table_file).writerow((csv_name, offset, len(rows), len(value_columns), " ".join(value_columns)))
+        self.blocks[csv_name] = (offset, len(rows), len(value_columns), value_columns)
+
+    def get_rows_of_block(self, csv_name: str) -> numpy.ndarray:
+        offset, number_of_rows, _, _ = self.blocks[csv_name]
+        if number_of_rows == 0:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.memmap(self.path_to_blocks, dtype=numpy.int64, mode="r", offset=offset, shape=(number_of_rows,))
+
 
 """
 ***********************************************************************************************************************
@@ -21,9 +220,17 @@ class DataMerger:
     """
     Class that can merge fetched data from prometheus in operate first.
     """
-    def __init__(self, path_to_data: str):
+    def __init__(self, path_to_data: str, executor: ProcessPoolExecutor = None, memory_budget: MemoryBudget = None,
+                 build_cache: BuildCache = None):
         self.path_to_data = path_to_data
         self.folder_path = f"../data/step_2__data_islands/{path_to_data.split('/')[-1]}"
+        # when an executor is given independent pairs are merged in parallel, see __perform_merging_iteration
+        self.executor = executor
+        self.memory_budget = memory_budget
+        # when a build cache is given merges whose output is up to date are skipped
+        self.build_cache = build_cache
+        # (process id, seconds) of every merge that ran in a worker
+        self.worker_timings = []
 
     """
     *******************************************************************************************************************
@@ -31,27 +238,36 @@ class DataMerger:
     *******************************************************************************************************************
     """
 
-    @staticmethod
-    def __is_not_time_stamp(some_string: str):
-        has_digit = any(char.isdigit() for char in some_string)
-        has_line = some_string.count("-") > 0
-        return not has_digit and not has_line
+    TIME_STAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}_\d{2}_\d{2}")
 
     @staticmethod
-    def __get_cols_to_merge_on(df_1, df_2):
-        cols1 = list(df_1.columns)
-        cols2 = list(df_2.columns)
-        cols_intersection = list(set(cols1).intersection(cols2))
-        filtered_cols_intersection = list(filter(DataMerger.__is_not_time_stamp, cols_intersection))
-        return filtered_cols_intersection
+    def __is_not_time_stamp(some_string: str):
+        return DataMerger.TIME_STAMP_PATTERN.fullmatch(some_string) is None
 
     def __get_merger_of_two_data_frames(self, left_df, right_df):
+        """
+        Rows of left_df keep their place, series that only right_df has are appended at the end.
+        The labels are the union of the labels of both, a label that one side lacks is None in its series.
+        """
         start = time.time()
-        merged_df = left_df.merge(
-            right=right_df,
-            how="outer",
-            sort=True,
-            on=self.__get_cols_to_merge_on(df_1=left_df, df_2=right_df)
+        left_label_columns = self.__get_label_columns(left_df)
+        right_label_columns = self.__get_label_columns(right_df)
+        left_value_columns = [column for column in left_df.columns if column not in left_label_columns]
+        right_value_columns = [column for column in right_df.columns if column not in right_label_columns]
+
+        series_index = SeriesIndex(left_label_columns)
+        left_rows = series_index.get_rows(left_df[left_label_columns])
+        right_rows = series_index.get_rows(right_df[right_label_columns])
+        values = numpy.full((len(series_index), len(left_value_columns) + len(right_value_columns)), numpy.nan)
+        values[left_rows, :len(left_value_columns)] = left_df[left_value_columns].to_numpy(dtype=numpy.float64)
+        values[right_rows, len(left_value_columns):] = right_df[right_value_columns].to_numpy(dtype=numpy.float64)
+
+        merged_df = pandas.concat(
+            [
+                series_index.get_labels_data_frame(),
+                pandas.DataFrame(values, columns=left_value_columns + right_value_columns)
+            ],
+            axis=1
         )
         end = time.time()
         print("merging took ", end - start)
@@ -62,21 +278,37 @@ class DataMerger:
         print("Save to path = ", path)
         start = time.time()
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        data_frame.to_csv(
-            path_or_buf=path,
-        )
+        if path.endswith(".parquet"):
+            "keep the values as float32 and the labels dictionary encoded"
+            data_frame = data_frame.astype({
+                column: (
+                    numpy.int64 if column == SeriesRegistry.SERIES_ID_COLUMN
+                    else "category" if DataMerger.__is_not_time_stamp(column)
+                    else numpy.float32
+                )
+                for column in data_frame.columns
+            })
+            data_frame.to_parquet(path, engine="pyarrow", index=False)
+        else:
+            data_frame.to_csv(
+                path_or_buf=path,
+            )
         end = time.time()
         print("writing took ", end - start)
 
     @staticmethod
     def __get_path_to_save_data_frame_in(first_csv_name, second_csv_name, destination_directory):
-        starting_hour_of_last_save_iteration = first_csv_name[:19]
-        ending_hour_of_current_iteration = second_csv_name[-23:-4]
-        path = f"{destination_directory}/{starting_hour_of_last_save_iteration}_to_{ending_hour_of_current_iteration}.csv"
+        first_csv_name_without_extension, extension = os.path.splitext(first_csv_name)
+        second_csv_name_without_extension = os.path.splitext(second_csv_name)[0]
+        starting_hour_of_last_save_iteration = first_csv_name_without_extension[:19]
+        ending_hour_of_current_iteration = second_csv_name_without_extension[-19:]
+        path = f"{destination_directory}/{starting_hour_of_last_save_iteration}_to_{ending_hour_of_current_iteration}{extension}"
         return path
 
     @staticmethod
     def __load_csv_as_data_frame(path_to_csv: str):
+        if path_to_csv.endswith(".parquet"):
+            return pandas.read_parquet(path_to_csv, engine="pyarrow")
         current_dataframe = pandas.read_csv(
             filepath_or_buffer=path_to_csv,
             index_col=0
@@ -85,7 +317,10 @@ class DataMerger:
 
     @staticmethod
     def __get_names_of_files_in_directory_sorted(directory_path):
-        csv_names = [f for f in listdir(directory_path) if isfile(join(directory_path, f))]
+        csv_names = [
+            f for f in listdir(directory_path)
+            if isfile(join(directory_path, f)) and (f.endswith(".csv") or f.endswith(".parquet"))
+        ]
         csv_names.sort()
         return csv_names
 
@@ -121,19 +356,363 @@ class DataMerger:
                 data_frame=merged_df
             )
 
-    def __perform_merging_iteration(self, csv_names, source_directory, destination_directory):
-        print("len(csv_names) = ", len(csv_names))
-        number_of_iterations = (len(csv_names) + 1) // 2
-        print("number_of_iterations = ", number_of_iterations)
-        for i in range(number_of_iterations):
-            print("progress = ", i + 1, " / ", number_of_iterations)
-            index_1 = 2 * i
+    @staticmethod
+    def __get_start_and_end_of_file(file_name):
+        file_name_without_extension = os.path.splitext(file_name)[0]
+        start = datetime.datetime.strptime(file_name_without_extension[:19], "%Y-%m-%d_%H_%M_%S")
+        end = datetime.datetime.strptime(file_name_without_extension[-19:], "%Y-%m-%d_%H_%M_%S")
+        return start, end
+
+    @staticmethod
+    def __get_label_columns(data_frame):
+        return [column for column in data_frame.columns if DataMerger.__is_not_time_stamp(column)]
+
+    def __get_window_index(self, csv_names):
+        "start and end time of every file, sorted by start time"
+        windows = [(*self.__get_start_and_end_of_file(csv_name), csv_name) for csv_name in csv_names]
+        window_index = pandas.DataFrame(windows, columns=["start", "end", "csv_name"])
+        return window_index.sort_values(by="start", kind="stable").reset_index(drop=True)
+
+    def __get_contiguous_runs(self, csv_names):
+        "files whose hours follow each other without a gap form one run"
+        window_index = self.__get_window_index(csv_names)
+        starts_new_run = window_index["start"] != window_index["end"].shift()
+        return [
+            list(run_window_index["csv_name"])
+            for _, run_window_index in window_index.groupby(starts_new_run.cumsum(), sort=True)
+        ]
+
+    def __write_gap_report(self, csv_names):
+        """
+        Writes the hours that are missing between the files to gap_report.csv next to the outputs.
+        """
+        window_index = self.__get_window_index(csv_names)
+        previous_end = window_index["end"].shift()
+        is_gap = window_index["start"] > previous_end
+        gap_report = pandas.DataFrame({
+            "missing_from": previous_end[is_gap],
+            "missing_until": window_index["start"][is_gap],
+            "number_of_missing_hours": (window_index["start"][is_gap] - previous_end[is_gap]) / pandas.Timedelta(hours=1)
+        })
+        os.makedirs(self.folder_path, exist_ok=True)
+        gap_report.to_csv(f"{self.folder_path}/gap_report.csv", index=False)
+        print("number of gaps = ", len(gap_report), ", missing hours = ", gap_report["number_of_missing_hours"].sum())
+
+    @staticmethod
+    def __write_chunk_of_single_pass_merge(path, chunk_df, is_first_chunk, parquet_writer, is_parquet):
+        if is_parquet:
+            import pyarrow  # only needed for parquet output
+            import pyarrow.parquet
+            table = pyarrow.Table.from_pandas(
+                chunk_df.astype({
+                    column: numpy.float32 for column in chunk_df.columns if not DataMerger.__is_not_time_stamp(column)
+                }),
+                preserve_index=False
+            )
+            if parquet_writer is None:
+                parquet_writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            parquet_writer.write_table(table)
+        else:
+            chunk_df.to_csv(path_or_buf=path, mode="w" if is_first_chunk else "a", header=is_first_chunk)
+        return parquet_writer
+
+    def __write_blocks_as_merged_file(self, path_to_blocks, blocks, time_stamp_columns, series_index, rows_of_output,
+                                      path):
+        """
+        Writes the series rows_of_output (in this order) of the blocks into one file in chunks of rows.
+        blocks are (offset, number of rows, number of stored columns, number of columns to use, first output column).
+        """
+        start = time.time()
+        position_of_row = numpy.full(len(series_index), -1, dtype=numpy.int64)
+        position_of_row[rows_of_output] = numpy.arange(len(rows_of_output))
+        "about 400MB of float64 values per chunk"
+        rows_per_chunk = max(1, 50_000_000 // max(1, len(time_stamp_columns)))
+        print("Save to path = ", path)
+        temporary_path = f"{path}.tmp"
+        parquet_writer = None
+        for chunk_start in range(0, max(1, len(rows_of_output)), rows_per_chunk):
+            chunk_end = min(chunk_start + rows_per_chunk, len(rows_of_output))
+            chunk_values = numpy.full((chunk_end - chunk_start, len(time_stamp_columns)), numpy.nan)
+            for offset, number_of_rows, number_of_stored_columns, number_of_columns, first_column in blocks:
+                if number_of_rows == 0:
+                    continue
+                rows = numpy.memmap(path_to_blocks, dtype=numpy.int64, mode="r", offset=offset, shape=(number_of_rows,))
+                values = numpy.memmap(
+                    path_to_blocks, dtype=numpy.float64, mode="r", offset=offset + rows.nbytes,
+                    shape=(number_of_rows, number_of_stored_columns)
+                )
+                positions = position_of_row[rows]
+                is_in_chunk = (chunk_start <= positions) & (positions < chunk_end)
+                chunk_values[positions[is_in_chunk] - chunk_start, first_column:first_column + number_of_columns] = \
+                    values[is_in_chunk, :number_of_columns]
+            chunk_df = pandas.concat(
+                [
+                    series_index.get_labels_data_frame(rows=rows_of_output[chunk_start:chunk_end]),
+                    pandas.DataFrame(chunk_values, columns=time_stamp_columns)
+                ],
+                axis=1
+            )
+            chunk_df.index = numpy.arange(chunk_start, chunk_end)
+            parquet_writer = self.__write_chunk_of_single_pass_merge(
+                path=temporary_path,
+                chunk_df=chunk_df,
+                is_first_chunk=(chunk_start == 0),
+                parquet_writer=parquet_writer,
+                is_parquet=path.endswith(".parquet")
+            )
+        if parquet_writer is not None:
+            parquet_writer.close()
+        os.replace(temporary_path, path)
+        print("writing took ", time.time() - start)
+
+    def __write_run_into_blocks(self, run_csv_names, path_to_blocks):
+        """
+        Every hourly file is read exactly once and its columns are appended to a scratch file of blocks,
+        only the index of series (labels -> row) is kept in memory. The labels of the run are the union of the labels
+        of its files.
+        """
+        series_index = None
+        time_stamp_columns = []
+        blocks = []
+        start = time.time()
+        with open(path_to_blocks, "wb") as blocks_file:
+            for i, csv_name in enumerate(run_csv_names):
+                data_frame = self.__load_csv_as_data_frame(path_to_csv=f"{self.path_to_data}/{csv_name}")
+                label_columns = self.__get_label_columns(data_frame)
+                if series_index is None:
+                    series_index = SeriesIndex(label_columns)
+                value_columns = [column for column in data_frame.columns if column not in label_columns]
+                if i + 1 < len(run_csv_names):
+                    "drop last minute since the next file also has that sample"
+                    value_columns = value_columns[:-1]
+                rows = series_index.get_rows(data_frame[label_columns])
+                values = numpy.ascontiguousarray(data_frame[value_columns].to_numpy(dtype=numpy.float64))
+                blocks.append((
+                    blocks_file.tell(), len(rows), len(value_columns), len(value_columns), len(time_stamp_columns)
+                ))
+                blocks_file.write(rows.tobytes())
+                blocks_file.write(values.tobytes())
+                time_stamp_columns += value_columns
+        print("reading took ", time.time() - start)
+        return series_index, blocks, time_stamp_columns
+
+    def __merge_run_in_single_pass(self, run_csv_names, destination_directory):
+        "the output is written in chunks of rows from the blocks of the run"
+        os.makedirs(destination_directory, exist_ok=True)
+        path_to_blocks = f"{destination_directory}/blocks.tmp"
+        series_index, blocks, time_stamp_columns = self.__write_run_into_blocks(run_csv_names, path_to_blocks)
+        path = self.__get_path_to_save_data_frame_in(
+            first_csv_name=run_csv_names[0],
+            second_csv_name=run_csv_names[-1],
+            destination_directory=destination_directory
+        )
+        self.__write_blocks_as_merged_file(
+            path_to_blocks=path_to_blocks,
+            blocks=blocks,
+            time_stamp_columns=time_stamp_columns,
+            series_index=series_index,
+            rows_of_output=numpy.arange(len(series_index)),
+            path=path
+        )
+        os.remove(path_to_blocks)
+        return path
+
+    def __merge_run_out_of_core(self, run_csv_names, destination_directory, memory_limit_in_bytes):
+        """
+        Writes the run as a float32 matrix of series x minutes into a memory mapped file, labels of the rows and
+        the time axis go to a side index. Only one chunk of rows, sized by the memory limit, is filled at a time.
+        """
+        os.makedirs(destination_directory, exist_ok=True)
+        path_to_blocks = f"{destination_directory}/blocks.tmp"
+        series_index, blocks, time_stamp_columns = self.__write_run_into_blocks(run_csv_names, path_to_blocks)
+        path_without_extension = os.path.splitext(self.__get_path_to_save_data_frame_in(
+            first_csv_name=run_csv_names[0],
+            second_csv_name=run_csv_names[-1],
+            destination_directory=destination_directory
+        ))[0]
+        path_to_matrix = f"{path_without_extension}.f32"
+        print("Save to path = ", path_to_matrix)
+        start = time.time()
+        shape = (len(series_index), len(time_stamp_columns))
+        matrix = numpy.memmap(f"{path_to_matrix}.tmp", dtype=numpy.float32, mode="w+", shape=shape)
+        "the chunk of the matrix and the values of one block that fall into it have to fit the limit"
+        largest_block_width = max(number_of_columns for _, _, _, number_of_columns, _ in blocks)
+        rows_per_chunk = max(1, memory_limit_in_bytes // (4 * len(time_stamp_columns) + 16 * largest_block_width))
+        for chunk_start in range(0, len(series_index), rows_per_chunk):
+            chunk_end = min(chunk_start + rows_per_chunk, len(series_index))
+            chunk_values = matrix[chunk_start:chunk_end]
+            chunk_values[:] = numpy.nan
+            for offset, number_of_rows, number_of_stored_columns, number_of_columns, first_column in blocks:
+                if number_of_rows == 0:
+                    continue
+                rows = numpy.memmap(path_to_blocks, dtype=numpy.int64, mode="r", offset=offset, shape=(number_of_rows,))
+                values = numpy.memmap(
+                    path_to_blocks, dtype=numpy.float64, mode="r", offset=offset + rows.nbytes,
+                    shape=(number_of_rows, number_of_stored_columns)
+                )
+                is_in_chunk = (chunk_start <= rows) & (rows < chunk_end)
+                chunk_values[rows[is_in_chunk] - chunk_start, first_column:first_column + number_of_columns] = \
+                    values[is_in_chunk, :number_of_columns]
+            "write the chunk out so that its pages can be dropped before the next one"
+            matrix.flush()
+        del matrix
+        os.remove(path_to_blocks)
+        series_index.get_labels_data_frame().to_csv(f"{path_without_extension}.labels.csv", index=False)
+        with open(f"{path_without_extension}.json", "w") as side_index_file:
+            json.dump({"shape": shape, "dtype": "float32", "time_stamps": time_stamp_columns}, side_index_file)
+        os.replace(f"{path_to_matrix}.tmp", path_to_matrix)
+        print("writing took ", time.time() - start)
+        return path_to_matrix
+
+    def __export_segment_of_merged_store(self, merged_store, segment_csv_names, path):
+        "same result as merging the segment in a single pass, the last minute of every block but the last is dropped"
+        blocks = []
+        time_stamp_columns = []
+        for i, csv_name in enumerate(segment_csv_names):
+            offset, number_of_rows, number_of_stored_columns, block_time_stamp_columns = merged_store.blocks[csv_name]
+            number_of_columns = number_of_stored_columns - 1 if i + 1 < len(segment_csv_names) else number_of_stored_columns
+            blocks.append((offset, number_of_rows, number_of_stored_columns, number_of_columns, len(time_stamp_columns)))
+            time_stamp_columns += block_time_stamp_columns[:number_of_columns]
+        "series in order of their first appearance in the store"
+        rows_of_output = numpy.unique(numpy.concatenate(
+            [merged_store.get_rows_of_block(csv_name) for csv_name in segment_csv_names]
+        ))
+        self.__write_blocks_as_merged_file(
+            path_to_blocks=merged_store.path_to_blocks,
+            blocks=blocks,
+            time_stamp_columns=time_stamp_columns,
+            series_index=merged_store.series_index,
+            rows_of_output=rows_of_output,
+            path=path
+        )
+
+    @staticmethod
+    def __is_overlapping_any_interval(start, end, intervals):
+        return any(start < other_end and other_start < end for other_start, other_end in intervals)
+
+    def __get_key_of_build(self, input_paths, parameters):
+        return None if self.build_cache is None else self.build_cache.get_key(input_paths, parameters)
+
+    def __is_built(self, output_path, key):
+        if key is None or not self.build_cache.is_up_to_date(output_path, key):
+            return False
+        print("up to date, skipping ", output_path)
+        return True
+
+    def __record_build(self, output_path, key, is_intermediate=False):
+        if key is not None:
+            self.build_cache.record(output_path, key, is_intermediate=is_intermediate)
+
+    @staticmethod
+    def __estimate_memory_of_merge(paths):
+        "parsed data frames and the merge copies take a few times the size of the files, more for compressed parquet"
+        return sum(os.path.getsize(path) * (20 if path.endswith(".parquet") else 4) for path in paths)
+
+    @staticmethod
+    def __get_planned_merges(runs):
+        "(files of the run, index of the first file) of every merge, pairs never span a gap between runs"
+        return [
+            (run_csv_names, index_1)
+            for run_csv_names in runs if len(run_csv_names) > 1
+            for index_1 in range(0, len(run_csv_names), 2)
+        ]
+
+    def __get_output_and_key_of_merge(self, source_directory, destination_directory, csv_names, index_1):
+        "a merge of the last file of a run only moves it"
+        names_of_merge = csv_names[index_1:index_1 + 2]
+        output_path = self.__get_path_to_save_data_frame_in(
+            first_csv_name=names_of_merge[0],
+            second_csv_name=names_of_merge[-1],
+            destination_directory=destination_directory
+        )
+        key = self.__get_key_of_build(
+            [f"{source_directory}/{csv_name}" for csv_name in names_of_merge], {"stage": "pairwise_merge"}
+        )
+        return output_path, key
+
+    def __remove_stale_outputs(self, runs, planned_merges, source_directory, destination_directory):
+        "files of an earlier run of the merge that this iteration does not produce would be merged again"
+        if not os.path.isdir(destination_directory):
+            return
+        planned_outputs = {run_csv_names[0] for run_csv_names in runs if len(run_csv_names) == 1}
+        for run_csv_names, index_1 in planned_merges:
+            output_path, _ = self.__get_output_and_key_of_merge(
+                source_directory, destination_directory, run_csv_names, index_1
+            )
+            planned_outputs.add(os.path.basename(output_path))
+        for csv_name in self.__get_names_of_files_in_directory_sorted(directory_path=destination_directory):
+            if csv_name not in planned_outputs:
+                os.remove(f"{destination_directory}/{csv_name}")
+
+    def __copy_finished_runs(self, runs, source_directory, destination_directory):
+        "a run that is already one file is copied as it is"
+        os.makedirs(destination_directory, exist_ok=True)
+        for run_csv_names in runs:
+            if len(run_csv_names) == 1:
+                output_path = f"{destination_directory}/{run_csv_names[0]}"
+                key = self.__get_key_of_build([f"{source_directory}/{run_csv_names[0]}"], {"stage": "copy"})
+                if self.__is_built(output_path, key):
+                    continue
+                shutil.copyfile(f"{source_directory}/{run_csv_names[0]}", output_path)
+                self.__record_build(output_path, key, is_intermediate=True)
+
+    def __perform_merging_iteration_in_parallel(self, planned_merges, source_directory, destination_directory):
+        futures = []
+        for run_csv_names, index_1 in planned_merges:
+            output_path, key = self.__get_output_and_key_of_merge(
+                source_directory, destination_directory, run_csv_names, index_1
+            )
+            if self.__is_built(output_path, key):
+                continue
+            estimated_memory = self.__estimate_memory_of_merge(
+                [f"{source_directory}/{csv_name}" for csv_name in run_csv_names[index_1:index_1 + 2]]
+            )
+            if self.memory_budget is not None:
+                "wait until enough merges are done to have room for this one"
+                self.memory_budget.acquire(estimated_memory)
+            future = self.executor.submit(
+                merge_two_consecutive_files_in_worker,
+                path_to_data=self.path_to_data,
+                source_directory=source_directory,
+                destination_directory=destination_directory,
+                csv_names=run_csv_names,
+                index_1=index_1
+            )
+            if self.memory_budget is not None:
+                future.add_done_callback(lambda _, amount=estimated_memory: self.memory_budget.release(amount))
+            futures.append((future, output_path, key))
+        for i, (future, output_path, key) in enumerate(futures):
+            self.worker_timings.append(future.result())
+            self.__record_build(output_path, key, is_intermediate=True)
+            print("progress = ", i + 1, " / ", len(futures))
+
+    def __perform_merging_iteration(self, runs, source_directory, destination_directory):
+        print("number of runs = ", len(runs), ", number of files = ", sum(len(run_csv_names) for run_csv_names in runs))
+        planned_merges = self.__get_planned_merges(runs)
+        print("number_of_iterations = ", len(planned_merges))
+        self.__remove_stale_outputs(runs, planned_merges, source_directory, destination_directory)
+        self.__copy_finished_runs(runs, source_directory, destination_directory)
+        if self.executor is not None:
+            self.__perform_merging_iteration_in_parallel(
+                planned_merges=planned_merges,
+                source_directory=source_directory,
+                destination_directory=destination_directory
+            )
+            return
+        for i, (run_csv_names, index_1) in enumerate(planned_merges):
+            print("progress = ", i + 1, " / ", len(planned_merges))
+            output_path, key = self.__get_output_and_key_of_merge(
+                source_directory, destination_directory, run_csv_names, index_1
+            )
+            if self.__is_built(output_path, key):
+                continue
             self.__merge_two_consecutive_files_and_save_them(
                 source_directory=source_directory,
                 destination_directory=destination_directory,
-                csv_names=csv_names,
+                csv_names=run_csv_names,
                 index_1=index_1
             )
+            self.__record_build(output_path, key, is_intermediate=True)
 
     """
     *******************************************************************************************************************
@@ -147,21 +726,203 @@ class DataMerger:
         merge_iteration = 0
         source_directory = self.path_to_data
         destination_directory = f"{self.folder_path}/iteration_1"
+        self.__write_gap_report(self.__get_names_of_files_in_directory_sorted(directory_path=source_directory))
         while True:
             print("current iteration = ", (merge_iteration + 1))
             csv_names = self.__get_names_of_files_in_directory_sorted(directory_path=source_directory)
             assert len(csv_names) != 0
-            if len(csv_names) == 1:
+            "merges are planned inside every run of continuous hours, until every run is one file"
+            runs = self.__get_contiguous_runs(csv_names)
+            if len(runs) == len(csv_names):
                 break
             else:
                 self.__perform_merging_iteration(
-                    csv_names=csv_names,
+                    runs=runs,
                     source_directory=source_directory,
                     destination_directory=destination_directory
                 )
                 source_directory = destination_directory
                 destination_directory = f"{self.folder_path}/iteration_{merge_iteration + 2}"
             merge_iteration += 1
+        if self.build_cache is not None and source_directory != self.path_to_data:
+            "the files of the last iteration are the result, the earlier iterations may be evicted"
+            for csv_name in csv_names:
+                self.build_cache.mark_as_final(f"{source_directory}/{csv_name}")
+
+    def merge_two_consecutive_files(self, source_directory, destination_directory, csv_names, index_1):
+        """
+        Merges the files at index_1 and index_1 + 1 (or moves the last file), returns (process id, seconds).
+        Used by the workers of the parallel merge.
+        """
+        start = time.time()
+        self.__merge_two_consecutive_files_and_save_them(
+            source_directory=source_directory,
+            destination_directory=destination_directory,
+            csv_names=csv_names,
+            index_1=index_1
+        )
+        return os.getpid(), time.time() - start
+
+    def merge_data_in_single_pass(self):
+        """
+        Merges all the hourly files in one pass, one output file for every run of continuous hours.
+        """
+        csv_names = self.__get_names_of_files_in_directory_sorted(directory_path=self.path_to_data)
+        assert len(csv_names) != 0
+        self.__write_gap_report(csv_names)
+        runs = self.__get_contiguous_runs(csv_names)
+        print("number of continuous runs = ", len(runs))
+        paths = []
+        for i, run_csv_names in enumerate(runs):
+            print("progress = ", i + 1, " / ", len(runs), ", files in run = ", len(run_csv_names))
+            destination_directory = f"{self.folder_path}/single_pass"
+            output_path = self.__get_path_to_save_data_frame_in(
+                first_csv_name=run_csv_names[0],
+                second_csv_name=run_csv_names[-1],
+                destination_directory=destination_directory
+            )
+            key = self.__get_key_of_build(
+                [f"{self.path_to_data}/{csv_name}" for csv_name in run_csv_names], {"stage": "single_pass"}
+            )
+            if not self.__is_built(output_path, key):
+                output_path = self.__merge_run_in_single_pass(
+                    run_csv_names=run_csv_names,
+                    destination_directory=destination_directory
+                )
+                self.__record_build(output_path, key)
+            paths.append(output_path)
+        return paths
+
+    def merge_data_out_of_core(self, memory_limit_in_bytes: int):
+        """
+        Merges every run of continuous hours into a memory mapped float32 matrix of series x minutes,
+        see load_memory_mapped_merge. At most about memory_limit_in_bytes of the matrix is filled at a time.
+        """
+        csv_names = self.__get_names_of_files_in_directory_sorted(directory_path=self.path_to_data)
+        assert len(csv_names) != 0
+        self.__write_gap_report(csv_names)
+        runs = self.__get_contiguous_runs(csv_names)
+        print("number of continuous runs = ", len(runs))
+        paths = []
+        for i, run_csv_names in enumerate(runs):
+            print("progress = ", i + 1, " / ", len(runs), ", files in run = ", len(run_csv_names))
+            destination_directory = f"{self.folder_path}/out_of_core"
+            "the memory limit only changes how the matrix is filled, not the matrix"
+            output_path = os.path.splitext(self.__get_path_to_save_data_frame_in(
+                first_csv_name=run_csv_names[0],
+                second_csv_name=run_csv_names[-1],
+                destination_directory=destination_directory
+            ))[0] + ".f32"
+            key = self.__get_key_of_build(
+                [f"{self.path_to_data}/{csv_name}" for csv_name in run_csv_names], {"stage": "out_of_core"}
+            )
+            if not self.__is_built(output_path, key):
+                output_path = self.__merge_run_out_of_core(
+                    run_csv_names=run_csv_names,
+                    destination_directory=destination_directory,
+                    memory_limit_in_bytes=memory_limit_in_bytes
+                )
+                self.__record_build(output_path, key)
+            paths.append(output_path)
+        return paths
+
+    @staticmethod
+    def load_memory_mapped_merge(path_to_matrix: str):
+        """
+        Returns the labels of the rows, the time stamps of the columns and the read only matrix of a merge
+        written by merge_data_out_of_core, the values stay on disk until they are used.
+        """
+        path_without_extension = os.path.splitext(path_to_matrix)[0]
+        with open(f"{path_without_extension}.json") as side_index_file:
+            side_index = json.load(side_index_file)
+        labels_df = pandas.read_csv(f"{path_without_extension}.labels.csv")
+        matrix = numpy.memmap(path_to_matrix, dtype=side_index["dtype"], mode="r", shape=tuple(side_index["shape"]))
+        return labels_df, side_index["time_stamps"], matrix
+
+    def append_new_files_to_merged_store(self):
+        """
+        Adds the hourly files that the merged store has not consumed yet, including files that were backfilled
+        before or between the hours it already has. Returns the number of files that were added.
+        """
+        merged_store = MergedStore(f"{self.folder_path}/store")
+        consumed_csv_names = set(merged_store.get_consumed_file_names())
+        consumed_intervals = [self.__get_start_and_end_of_file(csv_name) for csv_name in consumed_csv_names]
+        new_csv_names = [
+            csv_name for csv_name in self.__get_names_of_files_in_directory_sorted(directory_path=self.path_to_data)
+            if csv_name not in consumed_csv_names
+        ]
+        print("number of new files = ", len(new_csv_names))
+        number_of_added_files = 0
+        for csv_name in new_csv_names:
+            start, end = self.__get_start_and_end_of_file(csv_name)
+            if self.__is_overlapping_any_interval(start, end, consumed_intervals):
+                print("skipping ", csv_name, " since it overlaps hours that are already in the merged store")
+                continue
+            data_frame = self.__load_csv_as_data_frame(path_to_csv=f"{self.path_to_data}/{csv_name}")
+            merged_store.append(csv_name, data_frame, label_columns=self.__get_label_columns(data_frame))
+            consumed_intervals.append((start, end))
+            number_of_added_files += 1
+        return number_of_added_files
+
+    def update_live_segment_table(self):
+        """
+        Writes the continuous segments of the merged store to live/segments.csv (file name of the segment, its first
+        and last hourly file and its number of hours) and removes the files of segments that were extended or joined
+        by a backfilled hour. Only the table of blocks is read, so this costs the same however long the segments are.
+        Returns {file name of the segment: its hourly files}.
+        """
+        merged_store = MergedStore(f"{self.folder_path}/store")
+        live_directory = f"{self.folder_path}/live"
+        os.makedirs(live_directory, exist_ok=True)
+        segments = {
+            os.path.basename(self.__get_path_to_save_data_frame_in(
+                first_csv_name=segment_csv_names[0],
+                second_csv_name=segment_csv_names[-1],
+                destination_directory=live_directory
+            )): segment_csv_names
+            for segment_csv_names in self.__get_contiguous_runs(merged_store.get_consumed_file_names())
+        }
+        print("number of continuous segments = ", len(segments))
+        pandas.DataFrame(
+            [(name, csv_names[0], csv_names[-1], len(csv_names)) for name, csv_names in segments.items()],
+            columns=["file_name", "first_file", "last_file", "number_of_hours"]
+        ).to_csv(f"{live_directory}/segments.csv.tmp", index=False)
+        os.replace(f"{live_directory}/segments.csv.tmp", f"{live_directory}/segments.csv")
+        for name in self.__get_names_of_files_in_directory_sorted(directory_path=live_directory):
+            if name != "segments.csv" and name not in segments:
+                os.remove(f"{live_directory}/{name}")
+        return segments
+
+    def export_merged_store(self, segment_file_names=None):
+        """
+        Writes the file of every continuous segment (or of the segments in segment_file_names) of the merged store
+        into the 'live' directory, on demand. Segments whose file already exists did not change and are not written
+        again. A segment that was extended is written again as a whole, so this costs as much as the segment is long.
+        """
+        segments = self.update_live_segment_table()
+        live_directory = f"{self.folder_path}/live"
+        merged_store = MergedStore(f"{self.folder_path}/store")
+        paths = []
+        for name, segment_csv_names in segments.items():
+            if segment_file_names is not None and name not in segment_file_names:
+                continue
+            path = f"{live_directory}/{name}"
+            if not os.path.exists(path):
+                self.__export_segment_of_merged_store(merged_store, segment_csv_names, path)
+            paths.append(path)
+        return paths
+
+    def append_new_files_to_live_segments(self, write_segment_files: bool = True):
+        """
+        Merges only the new hourly files into the merged store and updates live/segments.csv.
+        With write_segment_files the files of the segments that changed are written too, see export_merged_store,
+        without it an update costs as much as the new hours and the files are written later on demand.
+        """
+        self.append_new_files_to_merged_store()
+        if write_segment_files:
+            self.export_merged_store()
+        else:
+            self.update_live_segment_table()
 
 
         # print("Saving final dataframe")
@@ -171,6 +932,204 @@ class DataMerger:
         # )
 
 
+"""
+***********************************************************************************************************************
+    Streaming Merger Class
+***********************************************************************************************************************
+"""
+
+
+class StreamingMerger:
+    """
+    Merges the hourly windows of one metric that arrive one by one and in any order, without files.
+    Every window is indexed as it arrives, a run of continuous hours is cut out as soon as no expected window
+    can extend it any more. A run is merged exactly like merge_data_in_single_pass merges the files of the run.
+    With max_hours_of_part a run that grows longer is given out in parts of that many hours while it still grows,
+    the parts of a run put together are the merged run.
+    """
+    def __init__(self, max_hours_of_part: int = None):
+        self.series_index = None
+        # start time -> (end time, rows in the series index, values, time stamp columns)
+        self.windows = {}
+        # (start time, end time) of the windows that are expected but did not arrive yet
+        self.expected_windows = set()
+        self.max_hours_of_part = max_hours_of_part
+        # start times of the parts that were given out, a run that ends at one of them is continued by it
+        self.start_times_of_given_out_parts = set()
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    @staticmethod
+    def __get_name_of_run(start_time, end_time):
+        "the name that the file of the run gets in step 2"
+        return f"{start_time}_to_{end_time}.csv".replace(":", "_").replace(" ", "_")
+
+    def __get_runs(self):
+        "start times of the windows of every run of continuous hours"
+        runs = []
+        previous_end_time = None
+        for start_time in sorted(self.windows):
+            if start_time != previous_end_time:
+                runs.append([])
+            runs[-1].append(start_time)
+            previous_end_time = self.windows[start_time][0]
+        return runs
+
+    def __is_run_finished(self, run_start_times):
+        run_start_time, run_end_time = run_start_times[0], self.windows[run_start_times[-1]][0]
+        return not any(
+            end_time == run_start_time or start_time == run_end_time for start_time, end_time in self.expected_windows
+        )
+
+    def __get_merged_data_frame_of_run(self, run_start_times, is_continued=False):
+        """
+        The last minute of every window but the last is dropped, the next window also has that sample.
+        The last window of a run that is continued by another part also drops it.
+        """
+        blocks = []
+        time_stamp_columns = []
+        for i, start_time in enumerate(run_start_times):
+            _, rows, values, window_time_stamp_columns = self.windows.pop(start_time)
+            is_last_minute_dropped = i + 1 < len(run_start_times) or is_continued
+            number_of_columns = len(window_time_stamp_columns) - (1 if is_last_minute_dropped else 0)
+            blocks.append((rows, values[:, :number_of_columns], len(time_stamp_columns)))
+            time_stamp_columns += window_time_stamp_columns[:number_of_columns]
+        "series in order of their first appearance in the run"
+        rows_of_output = pandas.unique(numpy.concatenate([rows for rows, _, _ in blocks]))
+        position_of_row = numpy.full(len(self.series_index), -1, dtype=numpy.int64)
+        position_of_row[rows_of_output] = numpy.arange(len(rows_of_output))
+        merged_values = numpy.full((len(rows_of_output), len(time_stamp_columns)), numpy.nan)
+        for rows, values, first_column in blocks:
+            merged_values[position_of_row[rows], first_column:first_column + values.shape[1]] = values
+        return pandas.concat(
+            [
+                self.series_index.get_labels_data_frame(rows=rows_of_output),
+                pandas.DataFrame(merged_values, columns=time_stamp_columns)
+            ],
+            axis=1
+        )
+
+    def __pop_part(self, run_start_times, is_cut_before_next_window=False):
+        "(name, merged data frame) of these windows, which are forgotten"
+        end_time = self.windows[run_start_times[-1]][0]
+        name = self.__get_name_of_run(run_start_times[0], end_time)
+        is_continued = is_cut_before_next_window or end_time in self.start_times_of_given_out_parts
+        self.start_times_of_given_out_parts.add(run_start_times[0])
+        return name, self.__get_merged_data_frame_of_run(run_start_times, is_continued=is_continued)
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def expect(self, windows):
+        """
+        windows are (start time, end time) of windows that will be given to append later,
+        the runs they could extend are held back until then.
+        """
+        self.expected_windows.update(windows)
+
+    def append(self, start_time, end_time, data_frame):
+        """
+        Adds the window of one hour, data_frame is laid out like an hourly file of step 1.
+        None means that the window has no data and only ends the wait for it.
+        """
+        self.expected_windows.discard((start_time, end_time))
+        if data_frame is None or len(data_frame) == 0:
+            return
+        assert start_time not in self.windows
+        label_columns = [
+            column for column in data_frame.columns if DataMerger.TIME_STAMP_PATTERN.fullmatch(column) is None
+        ]
+        if self.series_index is None:
+            self.series_index = SeriesIndex(label_columns)
+        time_stamp_columns = [column for column in data_frame.columns if column not in label_columns]
+        self.windows[start_time] = (
+            end_time,
+            self.series_index.get_rows(data_frame[label_columns]),
+            data_frame[time_stamp_columns].to_numpy(dtype=numpy.float64),
+            time_stamp_columns
+        )
+
+    def pop_finished_runs(self, is_every_window_in: bool = False):
+        """
+        Returns (name, merged data frame) of every run that no expected window can extend any more,
+        or of every run when is_every_window_in, and of every part of max_hours_of_part hours of a longer run.
+        The windows that are returned are forgotten.
+        """
+        finished_runs = []
+        for run_start_times in self.__get_runs():
+            if self.max_hours_of_part is not None:
+                "a part is only cut before a window that is already in, which has the last minute of the part"
+                while len(run_start_times) > self.max_hours_of_part:
+                    finished_runs.append(self.__pop_part(
+                        run_start_times[:self.max_hours_of_part], is_cut_before_next_window=True
+                    ))
+                    run_start_times = run_start_times[self.max_hours_of_part:]
+            if is_every_window_in or self.__is_run_finished(run_start_times):
+                finished_runs.append(self.__pop_part(run_start_times))
+        return finished_runs
+
+
+"""
+***********************************************************************************************************************
+    worker functions
+***********************************************************************************************************************
+"""
+
+
+def merge_two_consecutive_files_in_worker(path_to_data, source_directory, destination_directory, csv_names, index_1):
+    return DataMerger(path_to_data).merge_two_consecutive_files(
+        source_directory=source_directory,
+        destination_directory=destination_directory,
+        csv_names=csv_names,
+        index_1=index_1
+    )
+
+
+def get_build_cache_in_worker(build_cache_arguments):
+    "a connection to the cache can not be sent to a process, every worker opens its own"
+    return None if build_cache_arguments is None else BuildCache(**build_cache_arguments)
+
+
+def merge_data_in_single_pass_in_worker(path_to_data, build_cache_arguments=None):
+    start = time.time()
+    DataMerger(path_to_data, build_cache=get_build_cache_in_worker(build_cache_arguments)).merge_data_in_single_pass()
+    return os.getpid(), time.time() - start
+
+
+def merge_data_out_of_core_in_worker(path_to_data, memory_limit_in_bytes, build_cache_arguments=None):
+    start = time.time()
+    DataMerger(path_to_data, build_cache=get_build_cache_in_worker(build_cache_arguments)).merge_data_out_of_core(
+        memory_limit_in_bytes=memory_limit_in_bytes
+    )
+    return os.getpid(), time.time() - start
+
+
+def append_new_files_to_live_segments_in_worker(path_to_data, build_cache_arguments=None):
+    "the merged store already knows which hourly files it consumed, it does not need the build cache"
+    start = time.time()
+    DataMerger(path_to_data).append_new_files_to_live_segments()
+    return os.getpid(), time.time() - start
+
+
+def print_worker_timings(worker_timings):
+    total_seconds_of_worker = {}
+    number_of_merges_of_worker = {}
+    for process_id, seconds in worker_timings:
+        total_seconds_of_worker[process_id] = total_seconds_of_worker.get(process_id, 0) + seconds
+        number_of_merges_of_worker[process_id] = number_of_merges_of_worker.get(process_id, 0) + 1
+    print("worker timings:")
+    for process_id in sorted(total_seconds_of_worker):
+        print(f"    worker {process_id} : {number_of_merges_of_worker[process_id]} merges "
+              f"in {total_seconds_of_worker[process_id]:.2f} seconds")
+
+
 """
 ***********************************************************************************************************************
     main function
@@ -179,6 +1138,26 @@ class DataMerger:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Merge the hourly files of step 1.")
+    parser.add_argument("--mode", choices=["single-pass", "pairwise", "incremental", "out-of-core"],
+                        default="single-pass",
+                        help="single-pass reads every hourly file once, pairwise merges every two files repeatedly, "
+                             "incremental only merges the hourly files that are new since the last run, "
+                             "out-of-core writes a memory mapped float32 matrix within the memory limit")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes, the metrics and independent pairs are merged in parallel")
+    parser.add_argument("--memory-limit-gb", type=float, default=8,
+                        help="estimated memory that the parallel merges may use together, "
+                             "in out-of-core mode the memory that the matrices being filled may use together")
+    parser.add_argument("--no-build-cache", action="store_true",
+                        help="merge everything again instead of skipping the outputs that are up to date")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="compare the inputs by a hash of their content instead of their size and time")
+    parser.add_argument("--cache-intermediate-gb", type=float, default=None,
+                        help="disk space that the iteration_N files of the pairwise merge may keep, "
+                             "the least recently used ones are deleted above it")
+    arguments = parser.parse_args()
+
     print("""
     Thank you for using our tool. 
     This tool merges the data in 
@@ -186,18 +1165,83 @@ def main():
     ../data/step_1__continuous_data_fetching/container_memory_working_set_bytes
     ../data/step_1__continuous_data_fetching/node_memory_active_bytes_percentage
     
-    This script merges every two files and saves the output. 
+    In single-pass mode every hourly file is read once and appended to one output file 
+    for every run of continuous hours. Only the index of the series is kept in memory.
+    
+    In pairwise mode the script merges every two files and saves the output. 
     And does this repeatedly until we have one file.
-    It is designed to do so in order to reduce memory usage and be able to merge longer files.
+    
+    In incremental mode only the hourly files that were not merged before are appended to 
+    a merged store, and the continuous segments that changed are written to the live directory.
+    
+    In out-of-core mode every run of continuous hours is written into a memory mapped 
+    float32 matrix of series x minutes, with the labels and the time axis in a side index.
     """)
 
-    container_cpu_merger = DataMerger("../data/step_1__continuous_data_fetching/container_cpu_usage_seconds")
-    container_mem_merger = DataMerger("../data/step_1__continuous_data_fetching/container_memory_working_set_bytes")
-    node_mem_merger = DataMerger("../data/step_1__continuous_data_fetching/node_memory_active_bytes_percentage")
+    paths_to_data = [
+        "../data/step_1__continuous_data_fetching/container_cpu_usage_seconds",
+        "../data/step_1__continuous_data_fetching/container_memory_working_set_bytes",
+        "../data/step_1__continuous_data_fetching/node_memory_active_bytes_percentage",
+    ]
+
+    memory_limit_in_bytes = int(arguments.memory_limit_gb * 1024 ** 3)
+    build_cache_arguments = None if arguments.no_build_cache else {
+        "path_to_cache": "../data/step_2__data_islands/build_cache.sqlite",
+        "use_content_hash": arguments.content_hash,
+        "max_bytes_of_intermediates": (
+            None if arguments.cache_intermediate_gb is None else int(arguments.cache_intermediate_gb * 1024 ** 3)
+        ),
+    }
+    build_cache = None if build_cache_arguments is None else BuildCache(**build_cache_arguments)
+    if arguments.workers == 1:
+        for path_to_data in paths_to_data:
+            merger = DataMerger(path_to_data, build_cache=build_cache)
+            if arguments.mode == "out-of-core":
+                merger.merge_data_out_of_core(memory_limit_in_bytes=memory_limit_in_bytes)
+            elif arguments.mode == "single-pass":
+                merger.merge_data_in_single_pass()
+            elif arguments.mode == "incremental":
+                merger.append_new_files_to_live_segments()
+            else:
+                merger.merge_data()
+        if build_cache is not None:
+            build_cache.evict_intermediates()
+        return
 
-    container_cpu_merger.merge_data()
-    container_mem_merger.merge_data()
-    node_mem_merger.merge_data()
+    "one pool of processes and one memory budget are shared by all the metrics"
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+        if arguments.mode in ["single-pass", "incremental"]:
+            worker_function = (
+                merge_data_in_single_pass_in_worker if arguments.mode == "single-pass"
+                else append_new_files_to_live_segments_in_worker
+            )
+            futures = [executor.submit(worker_function, path, build_cache_arguments) for path in paths_to_data]
+            worker_timings = [future.result() for future in futures]
+        elif arguments.mode == "out-of-core":
+            "the metrics that are merged at the same time share the limit"
+            memory_limit_of_worker = memory_limit_in_bytes // min(arguments.workers, len(paths_to_data))
+            futures = [
+                executor.submit(merge_data_out_of_core_in_worker, path, memory_limit_of_worker, build_cache_arguments)
+                for path in paths_to_data
+            ]
+            worker_timings = [future.result() for future in futures]
+        else:
+            memory_budget = MemoryBudget(limit_in_bytes=memory_limit_in_bytes)
+            mergers = [
+                DataMerger(path, executor=executor, memory_budget=memory_budget, build_cache=build_cache)
+                for path in paths_to_data
+            ]
+            with ThreadPoolExecutor(max_workers=len(mergers)) as metric_executor:
+                futures = [metric_executor.submit(merger.merge_data) for merger in mergers]
+                for future in futures:
+                    future.result()
+            worker_timings = [timing for merger in mergers for timing in merger.worker_timings]
+            "only once no metric is merging any more, the cache is shared by all of them"
+            if build_cache is not None:
+                build_cache.evict_intermediates()
+    print_worker_timings(worker_timings)
+    print("total time = ", time.time() - start)
 
 
 """
@@ -4,14 +4,21 @@
 ***********************************************************************************************************************
 """
 
+import argparse
+import csv
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from os import listdir
 from os.path import isfile, join
 from typing import List
-import datetime
 import json
+import os
+from series_registry import SeriesRegistry
+from dataset_loader import DataSetLoader, DataSetWriter, SeriesStatistics
+from build_cache import BuildCache
 
 """
 ***********************************************************************************************************************
@@ -24,9 +31,35 @@ class DataSetMaker:
     """
     Class that can make a TimeSeriesDataSet from merged files.
     """
-    def __init__(self, source_path, destination_path):
+    # files that are read or split at the same time in parallel mode, each one is held in memory
+    FILES_IN_FLIGHT = 2
+    # chunks of rows of one file that are split or wait to be written at the same time in parallel mode
+    PARTS_IN_FLIGHT = 16
+    # bytes of a csv that the fast reading parses at a time, the rows of a block are parsed in parallel
+    FAST_CSV_BLOCK_SIZE = 1 << 24
+    # rows of a memory mapped merge (see merge_data_out_of_core in 02_merge_data.py) that are read at a time
+    MEMORY_MAPPED_ROWS_PER_BLOCK = 1 << 14
+    # files next to the merged files of step 2 that are not merged files themselves
+    EXTENSIONS_OF_SIDE_FILES = [".json", ".labels.csv"]
+    NAMES_OF_SIDE_FILES = ["segments.csv"]
+
+    def __init__(self, source_path, destination_path, series_registry: SeriesRegistry = None,
+                 output_format: str = "json", executor: ProcessPoolExecutor = None, rows_per_chunk: int = 1000,
+                 fast_csv_reading: bool = False, build_cache: BuildCache = None):
+        assert output_format in ["json", "binary"]
         self.source_path = source_path
         self.destination_path = destination_path
+        # needed to turn the series_id column of merged files back into labels
+        self.series_registry = series_registry
+        # binary datasets are read with DataSetLoader, see dataset_loader.py
+        self.output_format = output_format
+        # when an executor is given the chunks of rows are split in parallel, see __make_data_set_and_save_it
+        self.executor = executor
+        self.rows_per_chunk = rows_per_chunk
+        # values are read as float32, so the json output differs from the default path in the last digits
+        self.fast_csv_reading = fast_csv_reading
+        # when a build cache is given files whose dataset and statistics are up to date are skipped
+        self.build_cache = build_cache
 
     """
     *******************************************************************************************************************
@@ -63,13 +96,19 @@ class DataSetMaker:
         print(f"Reading dataframe.")
         print(f"csv_path = '{csv_path}'")
         _start = time.time()
-        df = pd.read_csv(
-            filepath_or_buffer=csv_path,
-            index_col=0,
-        )
+        if csv_path.endswith(".parquet"):
+            df = pd.read_parquet(csv_path, engine="pyarrow")
+        else:
+            df = pd.read_csv(
+                filepath_or_buffer=csv_path,
+                index_col=0,
+            )
         _end = time.time()
         print(f"Reading took {_end - _start} seconds")
+        return DataSetMaker.__prepare_data_frame(df)
 
+    @staticmethod
+    def __prepare_data_frame(df):
         first_dt = DataSetMaker.__get_first_index_that_is_not_time_stamp(df.columns)
         height_of_df = df.shape[0]
         width_of_df = df.shape[1]
@@ -89,88 +128,206 @@ class DataSetMaker:
 
         return df
 
+    @staticmethod
+    def __get_time_stamps_of_header(time_stamp_columns) -> pd.DatetimeIndex:
+        """
+        Only the first and last column are parsed, the columns in between are a fixed step apart,
+        unless some minutes are missing from the header, then every column is parsed.
+        """
+        time_stamp_format = '%Y-%m-%d_%H_%M_%S'
+        first = pd.to_datetime(time_stamp_columns[0], format=time_stamp_format)
+        last = pd.to_datetime(time_stamp_columns[-1], format=time_stamp_format)
+        step = pd.Timedelta(minutes=1)
+        if (last - first) / step + 1 == len(time_stamp_columns):
+            time_stamps = pd.date_range(start=first, end=last, freq=step)
+            if (time_stamps.strftime(time_stamp_format) == list(time_stamp_columns)).all():
+                return time_stamps
+        return pd.to_datetime(time_stamp_columns, format=time_stamp_format)
+
+    @staticmethod
+    def __read_csv_fast(csv_path):
+        """
+        Reads a merged csv with pyarrow one block of rows at a time, labels as categories and values as float32,
+        and returns the labels, the values and the time stamps without the empty columns and the almost empty rows.
+        Every type is declared, so a label that is empty or looks like a number in the first block does not decide
+        the type of its column.
+        Only the kept rows of every block are held, they are copied into one float32 array at the end.
+        """
+        import pyarrow  # only needed for fast csv reading
+        import pyarrow.csv
+        print(f"Reading dataframe (fast).")
+        print(f"csv_path = '{csv_path}'")
+        _start = time.time()
+        with open(csv_path, newline="") as a_file:
+            header = next(csv.reader(a_file))
+        "the first column is the index that was written by to_csv"
+        first_dt = DataSetMaker.__get_first_index_that_is_not_time_stamp(header)
+        label_columns, time_stamp_columns = header[1:first_dt], header[first_dt:]
+        reader = pyarrow.csv.open_csv(
+            csv_path,
+            read_options=pyarrow.csv.ReadOptions(block_size=DataSetMaker.FAST_CSV_BLOCK_SIZE),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={
+                    **{
+                        column: pyarrow.int64() if column == SeriesRegistry.SERIES_ID_COLUMN else pyarrow.string()
+                        for column in label_columns
+                    },
+                    **{column: pyarrow.float32() for column in time_stamp_columns}
+                },
+                include_columns=header[1:],
+                strings_can_be_null=True
+            )
+        )
+        labels_of_blocks = []
+        values_of_blocks = []
+        is_column_kept = np.zeros(len(time_stamp_columns), dtype=bool)
+        for batch in reader:
+            values_of_block = np.asarray(batch.select(range(len(label_columns), batch.num_columns)).to_tensor(
+                null_to_nan=True, row_major=True
+            ))
+            is_present = ~np.isnan(values_of_block)
+            "same filters as the default path: columns that are entirely empty, rows that are ALMOST entirely empty"
+            is_column_kept |= is_present.any(axis=0)
+            number_present_in_row = is_present.sum(axis=1)
+            for column in batch.columns[:len(label_columns)]:
+                number_present_in_row += column.is_valid().to_numpy(zero_copy_only=False)
+            is_row_kept = number_present_in_row >= (len(header) - 1) // 100
+            labels_of_blocks.append(batch.select(range(len(label_columns))).filter(pyarrow.array(is_row_kept)))
+            values_of_blocks.append(values_of_block[is_row_kept])
+        labels_df = pyarrow.Table.from_batches(
+            labels_of_blocks, schema=pyarrow.schema([reader.schema.field(column) for column in label_columns])
+        ).to_pandas()
+        for column in label_columns:
+            if column != SeriesRegistry.SERIES_ID_COLUMN:
+                labels_df[column] = labels_df[column].astype("category")
+        values = np.empty((len(labels_df), np.count_nonzero(is_column_kept)), dtype=np.float32)
+        first_row = 0
+        for i, values_of_block in enumerate(values_of_blocks):
+            values[first_row:first_row + len(values_of_block)] = values_of_block[:, is_column_kept]
+            first_row += len(values_of_block)
+            values_of_blocks[i] = None
+        time_stamps = DataSetMaker.__get_time_stamps_of_header(time_stamp_columns)[is_column_kept]
+        "the memory that pyarrow needed to parse the blocks is given back before the values are split"
+        pyarrow.default_memory_pool().release_unused()
+        _end = time.time()
+        print(f"Reading took {_end - _start} seconds")
+        return labels_df, values, time_stamps
+
+    @staticmethod
+    def __get_paths_of_side_index(path_to_matrix):
+        "the side index that merge_data_out_of_core writes next to every .f32 matrix"
+        path_without_extension = os.path.splitext(path_to_matrix)[0]
+        return f"{path_without_extension}.json", f"{path_without_extension}.labels.csv"
+
+    @staticmethod
+    def __read_memory_mapped_merge(path_to_matrix):
+        """
+        Reads a float32 matrix of series x minutes written by merge_data_out_of_core in 02_merge_data.py,
+        the same as DataMerger.load_memory_mapped_merge, and returns the labels, the values and the time stamps
+        without the empty columns and the almost empty rows. The filters are computed one block of rows at a time.
+        When nothing is dropped the values stay on disk until they are split, otherwise the kept ones are copied.
+        """
+        print(f"Reading memory mapped merge.")
+        print(f"path_to_matrix = '{path_to_matrix}'")
+        _start = time.time()
+        path_to_side_index, path_to_labels = DataSetMaker.__get_paths_of_side_index(path_to_matrix)
+        with open(path_to_side_index) as side_index_file:
+            side_index = json.load(side_index_file)
+        with open(path_to_labels, newline="") as a_file:
+            label_columns = next(csv.reader(a_file))
+        "labels that look like numbers stay strings, as in the merged csv files"
+        labels_df = pd.read_csv(path_to_labels, dtype={
+            column: "int64" if column == SeriesRegistry.SERIES_ID_COLUMN else "category" for column in label_columns
+        })
+        matrix = np.memmap(path_to_matrix, dtype=side_index["dtype"], mode="r", shape=tuple(side_index["shape"]))
+        assert matrix.dtype == np.float32 and len(labels_df) == matrix.shape[0]
+        "same filters as the default path: columns that are entirely empty, rows that are ALMOST entirely empty"
+        is_column_kept = np.zeros(matrix.shape[1], dtype=bool)
+        is_row_kept = np.zeros(matrix.shape[0], dtype=bool)
+        number_present_in_labels = labels_df.notna().sum(axis=1).to_numpy()
+        row_chunks = DataSetMaker.__get_row_chunks(matrix.shape[0], DataSetMaker.MEMORY_MAPPED_ROWS_PER_BLOCK)
+        for start, end in row_chunks:
+            is_present = ~np.isnan(matrix[start:end])
+            is_column_kept |= is_present.any(axis=0)
+            number_present_in_row = is_present.sum(axis=1) + number_present_in_labels[start:end]
+            is_row_kept[start:end] = number_present_in_row >= (len(label_columns) + matrix.shape[1]) // 100
+        if is_row_kept.all() and is_column_kept.all():
+            values = matrix
+        else:
+            values = np.empty((np.count_nonzero(is_row_kept), np.count_nonzero(is_column_kept)), dtype=np.float32)
+            first_row = 0
+            for start, end in row_chunks:
+                values_of_block = matrix[start:end][is_row_kept[start:end]][:, is_column_kept]
+                values[first_row:first_row + len(values_of_block)] = values_of_block
+                first_row += len(values_of_block)
+        labels_df = labels_df[is_row_kept].reset_index(drop=True)
+        time_stamps = DataSetMaker.__get_time_stamps_of_header(side_index["time_stamps"])[is_column_kept]
+        _end = time.time()
+        print(f"Reading took {_end - _start} seconds")
+        return labels_df, values, time_stamps
+
     @staticmethod
     def __get_names_of_files_in_directory_sorted(directory_path):
-        csv_names = [f for f in listdir(directory_path) if (isfile(join(directory_path, f)) and ("txt" not in f))]
+        csv_names = [
+            f for f in listdir(directory_path)
+            if isfile(join(directory_path, f)) and ("txt" not in f) and (f not in DataSetMaker.NAMES_OF_SIDE_FILES)
+            and not any(f.endswith(extension) for extension in DataSetMaker.EXTENSIONS_OF_SIDE_FILES)
+        ]
         csv_names.sort()
         return csv_names
 
     @staticmethod
-    def __are_we_about_to_skip_a_minute(j: int, row_of_df):
-        assert (0 <= j) and (j < len(row_of_df))
-        if (j + 1) == len(row_of_df):
-            return True
-        else:
-            ind = row_of_df.index
-            ind_j = ind[j]
-            ind_jp1 = ind[j + 1]
-            diff = ind_jp1 - ind_j
-            return diff > datetime.timedelta(minutes=1)
+    def __get_key_of_labels(labels_of_row: tuple, label_columns, series_registry: SeriesRegistry):
+        if list(label_columns) == [SeriesRegistry.SERIES_ID_COLUMN]:
+            "labels are only resolved now, when exporting"
+            assert series_registry is not None
+            return series_registry.get_key(int(labels_of_row[0]))
+        return ', '.join(label for label in labels_of_row if not pd.isna(label))
 
     @staticmethod
-    def __extract_time_series_list_from_range(row_of_df, last_time_series_index, next_time_series_index):
-        "take the time series we just saw out"
-        uninterrupted_time_series_as_pandas_series = row_of_df[last_time_series_index: next_time_series_index]
+    def __get_continuous_runs(values, time_stamps):
+        """
+        Finds the runs of present values that follow each other minute by minute, for all rows at once.
+        Returns the row, first column and last column of every run (in order of rows and then time)
+        and the present values in the same order, so that every run is a slice of them.
+        """
+        rows, columns = np.nonzero(~np.isnan(values))
+        present_values = values[rows, columns]
+        minutes = np.asarray((time_stamps - time_stamps[0]) // pd.Timedelta(minutes=1))[columns]
+        "a run starts at a new row, or after a missing minute"
+        starts_run = np.ones(len(rows), dtype=bool)
+        starts_run[1:] = (np.diff(rows) != 0) | (np.diff(minutes) > 1)
+        run_starts = np.flatnonzero(starts_run)
+        run_ends = np.append(run_starts[1:], len(rows))
+        assert ((minutes[run_ends - 1] - minutes[run_starts] + 1) == (run_ends - run_starts)).all()
+        return rows[run_starts], columns[run_starts], columns[run_ends - 1], run_starts, run_ends, present_values
 
-        "turn time series into list of tuples of timestamp and value"
-        uninterrupted_time_series_as_df = pd.DataFrame(uninterrupted_time_series_as_pandas_series)
-        uninterrupted_time_series_as_iter_tuples = uninterrupted_time_series_as_df.itertuples(
-            index=False, name=None
-        )
-        uninterrupted_time_series_as_list = [x[0] for x in uninterrupted_time_series_as_iter_tuples]
-        start_time = row_of_df.index[last_time_series_index]
-        stop_time = row_of_df.index[next_time_series_index - 1]
-        time_delta_in_minutes = (stop_time - start_time).total_seconds() / 60
-        assert (time_delta_in_minutes + 1) == len(uninterrupted_time_series_as_list)
-        return {
-            "start": start_time,
-            "stop": stop_time,
-            "data": uninterrupted_time_series_as_list
-        }
-
-    @staticmethod
-    def __get_key_and_list_of_time_series_for_row_in_df(row_of_df, first_index_not_time_stamp):
-        result = []
-
-        "drop rows that are entirely empty"
-        row_of_df = row_of_df.dropna()
-
-        "figure out what they key of the dictionary should be"
-        key_of_dict = ', '.join(row_of_df[:first_index_not_time_stamp])
-
-        number_of_columns = len(row_of_df)
-        last_time_series_index = first_index_not_time_stamp
-
-        for j in range(first_index_not_time_stamp, number_of_columns):
-            if DataSetMaker.__are_we_about_to_skip_a_minute(j=j, row_of_df=row_of_df):
-                current_item = DataSetMaker.__extract_time_series_list_from_range(
-                    row_of_df=row_of_df,
-                    last_time_series_index=last_time_series_index,
-                    next_time_series_index=j + 1
-                )
-                result.append(current_item)
-                last_time_series_index = j + 1
-        return key_of_dict, result
+    @staticmethod
+    def __get_keys_of_rows(labels_df, series_registry: SeriesRegistry):
+        keys_of_rows = [
+            DataSetMaker.__get_key_of_labels(labels_of_row, labels_df.columns, series_registry)
+            for labels_of_row in labels_df.itertuples(index=False, name=None)
+        ]
+        assert len(set(keys_of_rows)) == len(keys_of_rows)
+        return keys_of_rows
 
     @staticmethod
-    def __split_df(df):
-        result = {}
-        number_of_rows = df.shape[0]
+    def __split_data_frame(df):
+        """
+        Returns the labels, the values and the time stamps of a prepared data frame.
+        The values keep the type they were read as. They are only a view when the data frame holds them in one block,
+        otherwise they are copied once, so the caller should not keep the data frame.
+        """
         fi = DataSetMaker.__get_first_index_that_is_not_time_stamp(df.columns)
-        r = []
+        values = df.iloc[:, fi:].to_numpy()
+        if values.dtype.kind != "f":
+            "e.g. every column of an hour that only had whole numbers was read as int64"
+            values = values.astype(np.float64)
+        return df.iloc[:, :fi], values, pd.DatetimeIndex(df.columns[fi:])
 
-        print("Splitting data:")
-        for i in range(number_of_rows):
-            print(f"Iteration number {i + 1} / {number_of_rows}")
-            k, v = DataSetMaker.__get_key_and_list_of_time_series_for_row_in_df(
-                row_of_df=df.iloc[i],
-                first_index_not_time_stamp=fi
-            )
-            assert k not in result.keys()
-            result[k] = v
-            r += v
-        assert len(result) == number_of_rows
-        return result
+    @staticmethod
+    def __get_row_chunks(number_of_rows, rows_per_chunk):
+        return [(start, min(start + rows_per_chunk, number_of_rows)) for start in range(0, number_of_rows, rows_per_chunk)]
 
     """
     *******************************************************************************************************************
@@ -178,27 +335,145 @@ class DataSetMaker:
     *******************************************************************************************************************
     """
 
-    def __save_json_result(self, result, csv_file):
+    def __save_json_result(self, parts, csv_file):
+        """
+        Writes every part as soon as it is split, the bytes are the same as json.dump(result, indent=1) of the
+        whole result. The file only gets its name once it is complete.
+        """
         class PdEncoder(json.JSONEncoder):
             def default(self, obj):
                 if isinstance(obj, pd.Timestamp):
                     return str(obj)
+                if isinstance(obj, np.floating):
+                    return float(obj)
                 return json.JSONEncoder.default(self, obj)
 
         _start = time.time()
-        file_path = f"{self.destination_path}{csv_file[:-4]}.json"
+        file_path = f"{self.destination_path}{os.path.splitext(csv_file)[0]}.json"
         print(f"Writing json to '{file_path}'")
-        with open(file_path, "w") as a_file:
-            # print("Saving with indent = 1 !")
-            json.dump(result, a_file, indent=1, cls=PdEncoder)
+        is_first_item = True
+        with open(f"{file_path}.tmp", "w") as a_file:
+            a_file.write("{")
+            for _, part in parts:
+                for k, v in part.items():
+                    "without its braces a dictionary of one item is indented as the item in the whole dictionary"
+                    a_file.write(("\n" if is_first_item else ",\n") + json.dumps({k: v}, indent=1, cls=PdEncoder)[2:-2])
+                    is_first_item = False
+            a_file.write("}" if is_first_item else "\n}")
+        os.replace(f"{file_path}.tmp", file_path)
         _end = time.time()
-        print(f"Reading took {_end - _start} seconds")
+        print(f"Splitting and writing took {_end - _start} seconds")
         return file_path
 
+    def __save_binary_result(self, parts, keys_of_rows, csv_file):
+        _start = time.time()
+        path_to_data_set = f"{self.destination_path}{os.path.splitext(csv_file)[0]}.dataset"
+        print(f"Writing binary dataset to '{path_to_data_set}'")
+        data_set_writer = DataSetWriter(path_to_data_set)
+        for first_row, (segments, values_of_part) in parts:
+            segments["series"] += first_row
+            data_set_writer.append(segments=segments, values=values_of_part)
+        data_set_writer.close(keys=keys_of_rows)
+        _end = time.time()
+        print(f"Splitting and writing took {_end - _start} seconds")
+        return path_to_data_set
+
+    def __save_statistics(self, statistics_of_parts, csv_file):
+        "see SeriesStatistics in dataset_loader.py"
+        file_path = f"{self.destination_path}{os.path.splitext(csv_file)[0]}{SeriesStatistics.FILE_EXTENSION}"
+        print(f"Writing statistics of the series to '{file_path}'")
+        statistics = pd.concat(statistics_of_parts, ignore_index=True) if statistics_of_parts else pd.DataFrame()
+        statistics.to_csv(f"{file_path}.tmp", index=False)
+        os.replace(f"{file_path}.tmp", file_path)
+        return file_path
+
+    def __get_parts(self, values, time_stamps, keys_of_rows, statistics_of_parts):
+        """
+        Yields (first row, part) of every chunk of rows in the order of the rows, so the result does not depend
+        on the chunks, and appends the statistics of the chunk to statistics_of_parts.
+        In parallel mode at most PARTS_IN_FLIGHT chunks are split or waiting to be written.
+        """
+        row_chunks = self.__get_row_chunks(len(keys_of_rows), self.rows_per_chunk)
+        print(f"Splitting {len(row_chunks)} chunks of rows")
+        if self.executor is None:
+            for start, end in row_chunks:
+                part, statistics = self.get_part_of_data_set(
+                    self.output_format, values[start:end], time_stamps, keys_of_rows[start:end]
+                )
+                statistics_of_parts.append(statistics)
+                yield start, part
+            return
+        futures = deque()
+        for start, end in row_chunks:
+            if len(futures) == DataSetMaker.PARTS_IN_FLIGHT:
+                first_row, (part, statistics) = futures.popleft().result()
+                statistics_of_parts.append(statistics)
+                yield first_row, part
+            futures.append(self.executor.submit(
+                get_part_of_data_set_in_worker,
+                first_row=start,
+                output_format=self.output_format,
+                values=values[start:end],
+                time_stamps=time_stamps,
+                keys_of_rows=keys_of_rows[start:end]
+            ))
+        while futures:
+            first_row, (part, statistics) = futures.popleft().result()
+            statistics_of_parts.append(statistics)
+            yield first_row, part
+
+    def __get_paths_of_outputs(self, csv_file):
+        name = os.path.splitext(csv_file)[0]
+        extension = ".dataset" if self.output_format == "binary" else ".json"
+        return [
+            f"{self.destination_path}{name}{extension}",
+            f"{self.destination_path}{name}{SeriesStatistics.FILE_EXTENSION}"
+        ]
+
+    def __get_key_of_build(self, csv_file):
+        "the registry only ever gets new ids, so the keys of the series of a file do not change with it"
+        input_paths = [f"{self.source_path}{csv_file}"]
+        if csv_file.endswith(".f32"):
+            input_paths += self.__get_paths_of_side_index(input_paths[0])
+        return self.build_cache.get_key(
+            input_paths,
+            {"stage": "dataset", "output_format": self.output_format, "fast_csv_reading": self.fast_csv_reading}
+        )
+
     def __make_data_set_and_save_it(self, csv_file):
-        df = self.__read_data_frame(csv_path=f"{self.source_path}{csv_file}")
-        time_series = self.__split_df(df=df)
-        file_path = self.__save_json_result(result=time_series, csv_file=csv_file)
+        if self.build_cache is not None:
+            key = self.__get_key_of_build(csv_file)
+            paths_of_outputs = self.__get_paths_of_outputs(csv_file)
+            if all(self.build_cache.is_up_to_date(path, key) for path in paths_of_outputs):
+                print(f"'{csv_file}' is up to date, skipping")
+                return
+        labels_df, values, time_stamps = self.__read_labels_and_values(csv_path=f"{self.source_path}{csv_file}")
+        file_path, statistics_path = self.__make_data_set_of_values(labels_df, values, time_stamps, csv_file)
+        if self.build_cache is not None:
+            self.build_cache.record(file_path, key)
+            self.build_cache.record(statistics_path, key)
+
+    def __read_labels_and_values(self, csv_path):
+        if csv_path.endswith(".f32"):
+            return self.__read_memory_mapped_merge(csv_path)
+        if self.fast_csv_reading and not csv_path.endswith(".parquet"):
+            return self.__read_csv_fast(csv_path)
+        "the data frame is only referenced here, so nothing but the labels and the values outlive this function"
+        df = self.__read_data_frame(csv_path=csv_path)
+        return self.__split_data_frame(df)
+
+    def __make_data_set_of_values(self, labels_df, values, time_stamps, csv_file):
+        keys_of_rows = self.__get_keys_of_rows(labels_df, self.series_registry)
+        del labels_df
+        print("Splitting data:")
+        statistics_of_parts = []
+        parts = self.__get_parts(values, time_stamps, keys_of_rows, statistics_of_parts)
+        if self.output_format == "binary":
+            file_path = self.__save_binary_result(parts=parts, keys_of_rows=keys_of_rows, csv_file=csv_file)
+        else:
+            file_path = self.__save_json_result(parts=parts, csv_file=csv_file)
+        statistics_path = self.__save_statistics(statistics_of_parts=statistics_of_parts, csv_file=csv_file)
+        return file_path, statistics_path
 
     """
     *******************************************************************************************************************
@@ -206,10 +481,120 @@ class DataSetMaker:
     *******************************************************************************************************************
     """
 
+    @staticmethod
+    def split_rows(values, time_stamps, keys_of_rows, runs=None) -> dict:
+        """
+        Returns the runs of every row as {key: [{"start": ..., "stop": ..., "data": [...]}, ...]}.
+        """
+        result = {k: [] for k in keys_of_rows}
+        run_rows, run_first_columns, run_last_columns, run_starts, run_ends, present_values = \
+            runs or DataSetMaker.__get_continuous_runs(values, time_stamps)
+        for row, first_column, last_column, run_start, run_end in zip(
+                run_rows, run_first_columns, run_last_columns, run_starts, run_ends):
+            result[keys_of_rows[row]].append({
+                "start": time_stamps[first_column],
+                "stop": time_stamps[last_column],
+                "data": present_values[run_start:run_end].tolist()
+            })
+        return result
+
+    @staticmethod
+    def get_segments_of_rows(values, time_stamps, runs=None):
+        """
+        Returns the segment table and the value buffer of the binary dataset of these rows.
+        The present values of all the runs already follow each other in the order of the runs,
+        so they are the value buffer as they are.
+        """
+        run_rows, run_first_columns, _, run_starts, run_ends, present_values = \
+            runs or DataSetMaker.__get_continuous_runs(values, time_stamps)
+        segments = np.empty(len(run_rows), dtype=DataSetLoader.SEGMENT_TYPE)
+        segments["series"] = run_rows
+        segments["offset"] = run_starts
+        segments["length"] = run_ends - run_starts
+        segments["start"] = np.asarray(
+            (time_stamps - pd.Timestamp(0)) // pd.Timedelta(minutes=1), dtype=np.int64
+        )[run_first_columns]
+        return segments, present_values
+
+    @staticmethod
+    def get_statistics_of_rows(values, time_stamps, keys_of_rows, runs=None) -> pd.DataFrame:
+        """
+        Min, max, mean, std, number of values, longest continuous segment (in minutes) and coverage
+        (share of the minutes of the file that have a value) of every row.
+        """
+        run_rows, _, _, run_starts, run_ends, present_values = \
+            runs or DataSetMaker.__get_continuous_runs(values, time_stamps)
+        "float32 values are summed up as float64 too, only the present values of the chunk are converted"
+        present_values = present_values.astype(np.float64, copy=False)
+        "the present values are ordered by row, every row is reduced on its own so chunks of rows do not matter"
+        length = np.bincount(run_rows, weights=run_ends - run_starts, minlength=len(keys_of_rows)).astype(np.int64)
+        longest_segment = np.zeros(len(keys_of_rows), dtype=np.int64)
+        np.maximum.at(longest_segment, run_rows, run_ends - run_starts)
+        has_values = length > 0
+        first_value_of_rows = (np.cumsum(length) - length)[has_values]
+        mean = np.full(len(keys_of_rows), np.nan)
+        std = np.full(len(keys_of_rows), np.nan)
+        minimum = np.full(len(keys_of_rows), np.nan)
+        maximum = np.full(len(keys_of_rows), np.nan)
+        if len(present_values) > 0:
+            mean[has_values] = np.add.reduceat(present_values, first_value_of_rows) / length[has_values]
+            deviations = present_values - np.repeat(mean[has_values], length[has_values])
+            std[has_values] = np.sqrt(np.add.reduceat(deviations ** 2, first_value_of_rows) / length[has_values])
+            minimum[has_values] = np.minimum.reduceat(present_values, first_value_of_rows)
+            maximum[has_values] = np.maximum.reduceat(present_values, first_value_of_rows)
+        minutes_of_file = (time_stamps[-1] - time_stamps[0]) // pd.Timedelta(minutes=1) + 1 if len(time_stamps) else 0
+        return pd.DataFrame({
+            "key": keys_of_rows,
+            "min": minimum,
+            "max": maximum,
+            "mean": mean,
+            "std": std,
+            "length": length,
+            "longest_segment": longest_segment,
+            "coverage": length / max(minutes_of_file, 1),
+        })
+
+    @staticmethod
+    def get_part_of_data_set(output_format, values, time_stamps, keys_of_rows):
+        """
+        Returns the part of the dataset and the statistics of these rows, the runs are only found once for both.
+        """
+        runs = DataSetMaker.__get_continuous_runs(values, time_stamps)
+        statistics = DataSetMaker.get_statistics_of_rows(values, time_stamps, keys_of_rows, runs=runs)
+        if output_format == "binary":
+            return DataSetMaker.get_segments_of_rows(values, time_stamps, runs=runs), statistics
+        return DataSetMaker.split_rows(values, time_stamps, keys_of_rows, runs=runs), statistics
+
+    def make_data_set_of_data_frame(self, df, csv_file):
+        """
+        Makes the dataset of a merged data frame that is already in memory, laid out like a merged file of step 2.
+        csv_file is the name that the merged file would have, the outputs are named after it. See run_pipeline.py.
+        """
+        labels_df, values, time_stamps = self.__split_data_frame(self.__prepare_data_frame(df.copy(deep=False)))
+        return self.__make_data_set_of_values(labels_df, values, time_stamps, csv_file)
+
     def make_data_sets_and_save_them(self):
         list_of_files = self.__get_names_of_files_in_directory_sorted(self.source_path)
-        for csv_file in list_of_files:
-            self.__make_data_set_and_save_it(csv_file=csv_file)
+        if self.executor is None:
+            for csv_file in list_of_files:
+                self.__make_data_set_and_save_it(csv_file=csv_file)
+            return
+        "the next file is read while the chunks of the current one are split"
+        with ThreadPoolExecutor(max_workers=DataSetMaker.FILES_IN_FLIGHT) as file_executor:
+            futures = [file_executor.submit(self.__make_data_set_and_save_it, csv_file) for csv_file in list_of_files]
+            for future in futures:
+                future.result()
+
+
+"""
+***********************************************************************************************************************
+    worker functions
+***********************************************************************************************************************
+"""
+
+
+def get_part_of_data_set_in_worker(first_row, output_format, values, time_stamps, keys_of_rows):
+    return first_row, DataSetMaker.get_part_of_data_set(output_format, values, time_stamps, keys_of_rows)
 
 
 """
@@ -220,6 +605,21 @@ class DataSetMaker:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Make datasets out of the merged files of step 2.")
+    parser.add_argument("--output-format", choices=["json", "binary"], default="json",
+                        help="binary writes a float32 buffer with a table of segments, see dataset_loader.py")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes, chunks of rows of every file are split in parallel")
+    parser.add_argument("--rows-per-chunk", type=int, default=1000)
+    parser.add_argument("--fast-csv-reading", action="store_true",
+                        help="read csv files with pyarrow block by block, "
+                             "the labels as categories and the values as float32")
+    parser.add_argument("--no-build-cache", action="store_true",
+                        help="make every dataset again instead of skipping the ones that are up to date")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="compare the merged files by a hash of their content instead of their size and time")
+    arguments = parser.parse_args()
+
     print("""
     This script takes a merged data file from the previous step
     and makes a dataset out of that data. This data can then be 
@@ -230,11 +630,26 @@ def main():
     One dataset will be generated for each file.
     """)
 
-    dsm = DataSetMaker(
-        source_path="../data/step_3__data_sets/CSVs_to_turn_to_datasets/",
-        destination_path="../data/step_3__data_sets/datasets/"
-    )
-    dsm.make_data_sets_and_save_them()
+    def make_data_sets(executor):
+        dsm = DataSetMaker(
+            source_path="../data/step_3__data_sets/CSVs_to_turn_to_datasets/",
+            destination_path="../data/step_3__data_sets/datasets/",
+            series_registry=SeriesRegistry("../data/series_registry.csv"),
+            output_format=arguments.output_format,
+            executor=executor,
+            rows_per_chunk=arguments.rows_per_chunk,
+            fast_csv_reading=arguments.fast_csv_reading,
+            build_cache=None if arguments.no_build_cache else BuildCache(
+                "../data/step_3__data_sets/build_cache.sqlite", use_content_hash=arguments.content_hash
+            )
+        )
+        dsm.make_data_sets_and_save_them()
+
+    if arguments.workers == 1:
+        make_data_sets(executor=None)
+    else:
+        with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+            make_data_sets(executor=executor)
     print("Done!")
 
 
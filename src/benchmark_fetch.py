@@ -0,0 +1,116 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import tempfile
+import time
+from fake_prometheus_server import FakePrometheusServer
+
+# the step scripts start with a digit so they can not be imported with a plain import statement
+DataFetcher = importlib.import_module("01_fetch_data").DataFetcher
+
+"""
+***********************************************************************************************************************
+    benchmark function
+***********************************************************************************************************************
+"""
+
+
+def run_fetch_benchmark(fake_server: FakePrometheusServer, number_of_hours: int, max_requests_in_flight: int,
+                        hours_per_query: int, output_format: str) -> dict:
+    """
+    Fetches number_of_hours windows of every metric from fake_server into a temporary directory
+    and returns the measurements.
+    """
+    with tempfile.TemporaryDirectory() as path_to_data:
+        data_fetcher = DataFetcher(
+            access_token="benchmark",
+            url_to_fetch_from=fake_server.get_url(),
+            max_requests_in_flight=max_requests_in_flight,
+            hours_per_query=hours_per_query,
+            output_format=output_format,
+            path_to_data=path_to_data,
+            number_of_hours_to_fetch=number_of_hours
+        )
+        bytes_sent_before = fake_server.statistics["bytes_sent"]
+        _start = time.time()
+        # the fetcher prints a few lines for every window
+        with contextlib.redirect_stdout(io.StringIO()):
+            did_failure_happen = data_fetcher.get_metric_data_for_the_past_number_of_hours()
+        _end = time.time()
+        data_fetcher.close_connections()
+        data_fetcher.manifest.close()
+
+    seconds = _end - _start
+    bytes_received = fake_server.statistics["bytes_sent"] - bytes_sent_before
+    return {
+        "did_failure_happen": did_failure_happen,
+        "seconds": seconds,
+        "queries": data_fetcher.statistics["queries"],
+        "windows_written": data_fetcher.statistics["windows_written"],
+        "windows_per_second": data_fetcher.statistics["windows_written"] / seconds,
+        "bytes_per_second": bytes_received / seconds,
+        "conversion_seconds": data_fetcher.statistics["conversion_seconds"],
+    }
+
+
+"""
+***********************************************************************************************************************
+    main function
+***********************************************************************************************************************
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the fetcher against a local fake prometheus.")
+    parser.add_argument("--series", type=int, default=500, help="number of series in every response")
+    parser.add_argument("--gap-probability", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--hours", type=int, default=24, help="number of hourly windows per metric")
+    parser.add_argument("--max-requests-in-flight", type=int, default=8)
+    parser.add_argument("--hours-per-query", type=int, default=1)
+    parser.add_argument("--output-format", choices=["csv", "parquet"], default="csv")
+    arguments = parser.parse_args()
+
+    fake_server = FakePrometheusServer(
+        number_of_series=arguments.series,
+        gap_probability=arguments.gap_probability,
+        latency_seconds=arguments.latency,
+        error_rate=arguments.error_rate
+    )
+    fake_server.start()
+    try:
+        result = run_fetch_benchmark(
+            fake_server=fake_server,
+            number_of_hours=arguments.hours,
+            max_requests_in_flight=arguments.max_requests_in_flight,
+            hours_per_query=arguments.hours_per_query,
+            output_format=arguments.output_format
+        )
+    finally:
+        fake_server.stop()
+
+    print(f"failures happened  = {result['did_failure_happen']}")
+    print(f"total time         = {result['seconds']:.2f} seconds")
+    print(f"queries            = {result['queries']}")
+    print(f"windows written    = {result['windows_written']}")
+    print(f"windows per second = {result['windows_per_second']:.2f}")
+    print(f"bytes per second   = {result['bytes_per_second']:.0f}")
+    print(f"conversion time    = {result['conversion_seconds']:.2f} seconds")
+
+
+"""
+***********************************************************************************************************************
+    run main function
+***********************************************************************************************************************
+"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+"""
+***********************************************************************************************************************
+    Build Cache Class
+***********************************************************************************************************************
+"""
+
+
+class BuildCache:
+    """
+    Small sqlite file that remembers from which inputs and parameters every output of a stage was built,
+    so that a stage (or one merge of a stage) is skipped when its output is already up to date.
+    Inputs are identified by their size and modification time, and by a hash of their content if asked for.
+    Intermediate outputs (the iteration_N files of the pairwise merge) are evicted, least recently used first,
+    once they take more than max_bytes_of_intermediates. Their content hash is recorded, and an input that is
+    one of them is identified by it, so an evicted output that is built again does not change the keys after it.
+    """
+    def __init__(self, path_to_cache: str, use_content_hash: bool = False, max_bytes_of_intermediates: int = None):
+        self.path_to_cache = path_to_cache
+        self.use_content_hash = use_content_hash
+        self.max_bytes_of_intermediates = max_bytes_of_intermediates
+        directory = os.path.dirname(path_to_cache)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # mergers of several metrics share one cache, from threads or from processes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path_to_cache, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS outputs (
+                    output_path TEXT NOT NULL PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    output_identity TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    is_intermediate INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            "caches that were made before the content of intermediates was recorded"
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(outputs)")]
+            if "content_identity" not in columns:
+                try:
+                    self.connection.execute("ALTER TABLE outputs ADD COLUMN content_identity TEXT")
+                except sqlite3.OperationalError:
+                    "a worker that opened the cache at the same time added it first"
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    @staticmethod
+    def __get_files_of_path(path: str):
+        "a dataset is a directory of files"
+        if os.path.isdir(path):
+            return sorted(os.path.join(path, name) for name in os.listdir(path))
+        return [path]
+
+    @staticmethod
+    def __get_content_hash(path: str) -> str:
+        content_hash = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                content_hash.update(block)
+        return content_hash.hexdigest()
+
+    def __get_identity_of_path(self, path: str, use_content_hash: bool):
+        identity = []
+        for file_path in self.__get_files_of_path(path):
+            status = os.stat(file_path)
+            "a file that was only touched or copied again keeps its content hash"
+            identity.append([
+                os.path.basename(file_path),
+                status.st_size,
+                self.__get_content_hash(file_path) if use_content_hash else status.st_mtime_ns
+            ])
+        return identity
+
+    def __get_identity_of_input(self, path: str):
+        "an intermediate output that was not changed since it was recorded is identified by its content"
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT output_identity, content_identity FROM outputs WHERE output_path = ?", (path,)
+            ).fetchone()
+        identity = self.__get_identity_of_path(path, use_content_hash=False)
+        if row is not None and row[1] is not None and json.loads(row[0]) == identity:
+            return json.loads(row[1])
+        return self.__get_identity_of_path(path, use_content_hash=True) if self.use_content_hash else identity
+
+    def __get_size_of_path(self, path: str) -> int:
+        return sum(os.path.getsize(file_path) for file_path in self.__get_files_of_path(path))
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def get_key(self, input_paths, parameters: dict) -> str:
+        """
+        Returns the key of building from these input files with these parameters of the stage.
+        """
+        description = {
+            "inputs": [[input_path, self.__get_identity_of_input(input_path)] for input_path in input_paths],
+            "parameters": parameters,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_up_to_date(self, output_path: str, key: str) -> bool:
+        """
+        True when output_path was built with this key and was not changed since.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key, output_identity FROM outputs WHERE output_path = ?", (output_path,)
+            ).fetchone()
+        if row is None or row[0] != key or not os.path.exists(output_path):
+            return False
+        if json.loads(row[1]) != self.__get_identity_of_path(output_path, use_content_hash=False):
+            return False
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE outputs SET last_used = ? WHERE output_path = ?", (time.time(), output_path))
+        return True
+
+    def record(self, output_path: str, key: str, is_intermediate: bool = False):
+        """
+        Remembers that output_path was built with this key. The content of an intermediate output is hashed,
+        because it may be evicted and built again later.
+        """
+        output_identity = json.dumps(self.__get_identity_of_path(output_path, use_content_hash=False))
+        content_identity = json.dumps(self.__get_identity_of_path(output_path, use_content_hash=True)) \
+            if is_intermediate else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs "
+                "(output_path, key, output_identity, size, is_intermediate, last_used, content_identity) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (output_path, key, output_identity, self.__get_size_of_path(output_path), int(is_intermediate),
+                 time.time(), content_identity)
+            )
+
+    def mark_as_final(self, output_path: str):
+        "a final output is never evicted"
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE outputs SET is_intermediate = 0 WHERE output_path = ?", (output_path,))
+
+    def evict_intermediates(self):
+        """
+        Deletes the least recently used intermediate outputs until they fit max_bytes_of_intermediates,
+        a deleted output is simply built again when it is needed. Returns the number of bytes that were freed.
+        """
+        if self.max_bytes_of_intermediates is None:
+            return 0
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT output_path, size FROM outputs WHERE is_intermediate = 1 ORDER BY last_used"
+            ).fetchall()
+        rows = [(output_path, size) for output_path, size in rows if os.path.exists(output_path)]
+        total_size = sum(size for _, size in rows)
+        freed_bytes = 0
+        for output_path, size in rows:
+            if total_size - freed_bytes <= self.max_bytes_of_intermediates:
+                break
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            else:
+                os.remove(output_path)
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM outputs WHERE output_path = ?", (output_path,))
+            freed_bytes += size
+        print("evicted ", freed_bytes, " bytes of intermediate outputs")
+        return freed_bytes
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
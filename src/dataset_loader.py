@@ -0,0 +1,276 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import datetime
+import json
+import os
+import random
+import shutil
+import numpy as np
+import pandas as pd
+
+"""
+***********************************************************************************************************************
+    Data Set Loader Class
+***********************************************************************************************************************
+"""
+
+
+class DataSetLoader:
+    """
+    Reads the binary datasets of step 3 without copying them into memory.
+    A dataset is a directory with one contiguous float32 buffer of all the values (values.f32),
+    a table with the series, offset, length and start (in minutes since the epoch) of every segment (segments.npy)
+    and the keys of the series (keys.json). Segments of the same series follow each other in time order.
+    """
+    VALUES_FILE_NAME = "values.f32"
+    SEGMENTS_FILE_NAME = "segments.npy"
+    KEYS_FILE_NAME = "keys.json"
+    SEGMENT_TYPE = np.dtype([("series", np.int64), ("offset", np.int64), ("length", np.int64), ("start", np.int64)])
+
+    def __init__(self, path_to_data_set: str):
+        self.path_to_data_set = path_to_data_set
+        with open(f"{path_to_data_set}/{DataSetLoader.KEYS_FILE_NAME}") as keys_file:
+            self.keys = json.load(keys_file)
+        self.series_of_key = {key: series for series, key in enumerate(self.keys)}
+        self.segments = np.load(f"{path_to_data_set}/{DataSetLoader.SEGMENTS_FILE_NAME}", mmap_mode="r")
+        path_to_values = f"{path_to_data_set}/{DataSetLoader.VALUES_FILE_NAME}"
+        if os.path.getsize(path_to_values) == 0:
+            "an empty file can not be memory mapped"
+            self.values = np.empty(0, dtype=np.float32)
+        else:
+            self.values = np.memmap(path_to_values, dtype=np.float32, mode="r")
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    @staticmethod
+    def get_time_of_minute(minute: int) -> datetime.datetime:
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(minutes=int(minute))
+
+    def get_keys(self):
+        return self.keys
+
+    def get_segment(self, index_of_segment: int):
+        """
+        Returns the start minute and the values of a segment, the values are a view into the memory mapped buffer.
+        """
+        segment = self.segments[index_of_segment]
+        return int(segment["start"]), self.values[segment["offset"]:segment["offset"] + segment["length"]]
+
+    def get_segments(self, key: str):
+        """
+        Returns (start minute, values) of every segment of the series with this key, in time order.
+        """
+        series = self.series_of_key[key]
+        first, last = np.searchsorted(self.segments["series"], [series, series + 1])
+        return [self.get_segment(i) for i in range(first, last)]
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        "(key, start minute, values) of every segment"
+        for i in range(len(self.segments)):
+            start, values = self.get_segment(i)
+            yield self.keys[self.segments[i]["series"]], start, values
+
+
+"""
+***********************************************************************************************************************
+    Data Set Writer Class
+***********************************************************************************************************************
+"""
+
+
+class DataSetWriter:
+    """
+    Writes a dataset that DataSetLoader reads part by part, only the table of segments is kept in memory.
+    The files are written to a temporary directory that replaces path_to_data_set when it is closed.
+    """
+    def __init__(self, path_to_data_set: str):
+        self.path_to_data_set = path_to_data_set
+        self.temporary_path = f"{path_to_data_set}.tmp"
+        shutil.rmtree(self.temporary_path, ignore_errors=True)
+        os.makedirs(self.temporary_path)
+        self.values_file = open(f"{self.temporary_path}/{DataSetLoader.VALUES_FILE_NAME}", "wb")
+        self.number_of_values = 0
+        self.segments_of_parts = []
+
+    def append(self, segments: np.ndarray, values: np.ndarray):
+        """
+        segments is an array of DataSetLoader.SEGMENT_TYPE whose offsets point into values.
+        """
+        assert segments.dtype == DataSetLoader.SEGMENT_TYPE
+        segments = segments.copy()
+        segments["offset"] += self.number_of_values
+        self.segments_of_parts.append(segments)
+        self.values_file.write(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+        self.number_of_values += len(values)
+
+    def close(self, keys):
+        self.values_file.close()
+        segments = (
+            np.concatenate(self.segments_of_parts) if self.segments_of_parts
+            else np.empty(0, dtype=DataSetLoader.SEGMENT_TYPE)
+        )
+        np.save(f"{self.temporary_path}/{DataSetLoader.SEGMENTS_FILE_NAME}", segments)
+        with open(f"{self.temporary_path}/{DataSetLoader.KEYS_FILE_NAME}", "w") as keys_file:
+            json.dump(list(keys), keys_file)
+        shutil.rmtree(self.path_to_data_set, ignore_errors=True)
+        os.replace(self.temporary_path, self.path_to_data_set)
+
+
+"""
+***********************************************************************************************************************
+    Series Statistics Class
+***********************************************************************************************************************
+"""
+
+
+class SeriesStatistics:
+    """
+    Side index of a dataset with one row of statistics per series (key, min, max, mean, std, length,
+    longest_segment, coverage), written by step 3 next to the dataset. Lengths are in minutes.
+    It is read without touching the values of the dataset.
+    """
+    FILE_EXTENSION = ".statistics.csv"
+
+    def __init__(self, path_to_statistics: str):
+        self.path_to_statistics = path_to_statistics
+        self.data_frame = pd.read_csv(path_to_statistics, keep_default_na=False, na_values=[""], dtype={"key": str})
+        self.row_of_key = {key: row for row, key in enumerate(self.data_frame["key"])}
+
+    @staticmethod
+    def get_path_of_data_set(path_to_data_set: str) -> str:
+        "the statistics of a.json or a.dataset are in a.statistics.csv"
+        return f"{os.path.splitext(path_to_data_set.rstrip('/'))[0]}{SeriesStatistics.FILE_EXTENSION}"
+
+    def get_statistics(self, key: str) -> dict:
+        return self.data_frame.iloc[self.row_of_key[key]].to_dict()
+
+    def select(self, min_longest_segment: int = 0, min_length: int = 0, min_coverage: float = 0.0,
+               max_std: float = None):
+        """
+        Returns the keys of the series that pass all the filters,
+        e.g. select(min_longest_segment=24 * 60) for series with at least a day of continuous data.
+        """
+        is_selected = (
+            (self.data_frame["longest_segment"] >= min_longest_segment)
+            & (self.data_frame["length"] >= min_length)
+            & (self.data_frame["coverage"] >= min_coverage)
+        )
+        if max_std is not None:
+            is_selected &= self.data_frame["std"] <= max_std
+        return list(self.data_frame["key"][is_selected])
+
+
+"""
+***********************************************************************************************************************
+    Sliding Window Sampler Class
+***********************************************************************************************************************
+"""
+
+
+class SlidingWindowSampler:
+    """
+    Cuts (input, target) training windows out of continuous segments lazily, batch by batch.
+    A window is input_length values followed by target_length values, windows start every stride values.
+    Shuffling keeps at most shuffle_buffer_size windows (as views into their segment) in memory.
+    """
+    def __init__(self, input_length: int, target_length: int = 1, stride: int = 1, batch_size: int = 32,
+                 min_segment_length: int = None, shuffle_buffer_size: int = 0, drop_last: bool = False, seed: int = 0):
+        assert input_length > 0 and target_length > 0 and stride > 0 and batch_size > 0
+        self.input_length = input_length
+        self.target_length = target_length
+        self.stride = stride
+        self.batch_size = batch_size
+        self.window_length = input_length + target_length
+        # shorter segments do not even have one window
+        self.min_segment_length = max(min_segment_length or 0, self.window_length)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.drop_last = drop_last
+        self.random_generator = random.Random(seed)
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    def __get_windows_of_segment(self, values):
+        "views into values, nothing is copied"
+        windows = np.lib.stride_tricks.sliding_window_view(values, self.window_length)
+        return windows[::self.stride]
+
+    def __get_windows(self, segments):
+        for _, _, values in segments:
+            if len(values) < self.min_segment_length:
+                continue
+            yield from self.__get_windows_of_segment(values)
+
+    def __get_shuffled_windows(self, windows):
+        "every new window takes the place of a random window of the buffer, which is given out"
+        buffer = []
+        for window in windows:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(window)
+                continue
+            i = self.random_generator.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = window
+        self.random_generator.shuffle(buffer)
+        yield from buffer
+
+    def __get_batch(self, windows_of_batch):
+        batch = np.stack(windows_of_batch).astype(np.float32, copy=False)
+        return batch[:, :self.input_length], batch[:, self.input_length:]
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def get_batches(self, segments):
+        """
+        Yields (inputs, targets) arrays of shape (batch, input_length) and (batch, target_length).
+        segments is an iterable of (key, start minute, values), e.g. a DataSetLoader or read_json_data_set.
+        """
+        windows = self.__get_windows(segments)
+        if self.shuffle_buffer_size > 0:
+            windows = self.__get_shuffled_windows(windows)
+        windows_of_batch = []
+        for window in windows:
+            windows_of_batch.append(window)
+            if len(windows_of_batch) == self.batch_size:
+                yield self.__get_batch(windows_of_batch)
+                windows_of_batch = []
+        if windows_of_batch and not self.drop_last:
+            yield self.__get_batch(windows_of_batch)
+
+
+"""
+***********************************************************************************************************************
+    json datasets
+***********************************************************************************************************************
+"""
+
+
+def read_json_data_set(path_to_json: str):
+    """
+    Yields (key, start minute, values) of every segment of a json dataset of step 3, like DataSetLoader does.
+    """
+    with open(path_to_json) as json_file:
+        data_set = json.load(json_file)
+    for key, segments in data_set.items():
+        for segment in segments:
+            start = datetime.datetime.fromisoformat(segment["start"])
+            start_minute = int((start - datetime.datetime(1970, 1, 1)).total_seconds() // 60)
+            yield key, start_minute, np.asarray(segment["data"], dtype=np.float32)
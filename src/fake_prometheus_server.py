@@ -0,0 +1,213 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+"""
+***********************************************************************************************************************
+    Fake Prometheus Server Class
+***********************************************************************************************************************
+"""
+
+
+class FakePrometheusServer:
+    """
+    Local stand-in for the query_range api of prometheus (or thanos) that serves synthetic series.
+    It makes it possible to measure the fetcher without a token for the real cluster.
+    """
+    def __init__(self, number_of_series: int = 100, gap_probability: float = 0.0, latency_seconds: float = 0.0,
+                 error_rate: float = 0.0, max_points_per_series: int = 11000, seed: int = 0, port: int = 0):
+        assert 0 <= gap_probability <= 1
+        assert 0 <= error_rate <= 1
+        self.number_of_series = number_of_series
+        self.gap_probability = gap_probability
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.max_points_per_series = max_points_per_series
+        self.seed = seed
+        self.port = port
+        self.http_server = None
+        self.statistics = {"requests": 0, "errors": 0, "bytes_sent": 0}
+        self.statistics_lock = threading.Lock()
+        self.random_lock = threading.Lock()
+        self.random_generator = np.random.default_rng(seed)
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    @staticmethod
+    def __get_labels_of_series(series_index: int) -> dict:
+        return {
+            "container": f"container-{series_index}",
+            "namespace": f"namespace-{series_index % 10}",
+            "node": f"node-{series_index % 5}",
+            "pod": f"pod-{series_index // 3}",
+        }
+
+    def __get_series_of_query(self, query: str, start: float, end: float, step: float):
+        time_stamps = np.arange(start, end + step / 2, step)
+        result = []
+        for series_index in range(self.number_of_series):
+            # the same series, query and time always get the same values
+            seed = zlib.crc32(f"{self.seed}/{query}/{series_index}/{start}".encode())
+            series_random_generator = np.random.default_rng(seed)
+            values = series_random_generator.random(len(time_stamps))
+            is_present = series_random_generator.random(len(time_stamps)) >= self.gap_probability
+            if not is_present.any():
+                continue
+            result.append({
+                "metric": self.__get_labels_of_series(series_index),
+                "values": [[float(t), repr(float(v))] for t, v in zip(time_stamps[is_present], values[is_present])]
+            })
+        return result
+
+    def __add_to_statistics(self, **amounts):
+        with self.statistics_lock:
+            for name, amount in amounts.items():
+                self.statistics[name] += amount
+
+    def __should_fail(self) -> bool:
+        with self.random_lock:
+            return self.random_generator.random() < self.error_rate
+
+    def __handle_query_range(self, parameters: dict):
+        """
+        Returns status code and body of the response.
+        """
+        query = parameters["query"][0]
+        start = float(parameters["start"][0])
+        end = float(parameters["end"][0])
+        step = float(parameters["step"][0])
+        if self.__should_fail():
+            return 503, {"status": "error", "errorType": "unavailable", "error": "service unavailable"}
+        if (end - start) / step + 1 > self.max_points_per_series:
+            return 400, {
+                "status": "error",
+                "errorType": "bad_data",
+                "error": f"exceeded maximum resolution of {self.max_points_per_series} points per timeseries. "
+                         f"Try decreasing the query resolution (?step=XX)"
+            }
+        return 200, {
+            "status": "success",
+            "data": {"resultType": "matrix", "result": self.__get_series_of_query(query, start, end, step)}
+        }
+
+    def __get_request_handler_class(self):
+        # bound here, name mangling inside the handler class would refer to the handler class
+        latency_seconds = self.latency_seconds
+        handle_query_range = self.__handle_query_range
+        add_to_statistics = self.__add_to_statistics
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def __send_json(self, status_code: int, body: dict):
+                encoded_body = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded_body)))
+                self.end_headers()
+                self.wfile.write(encoded_body)
+                add_to_statistics(
+                    requests=1,
+                    errors=int(status_code != 200),
+                    bytes_sent=len(encoded_body)
+                )
+
+            def __handle(self, parameters: dict):
+                time.sleep(latency_seconds)
+                if urlparse(self.path).path != "/api/v1/query_range":
+                    self.__send_json(404, {"status": "error", "errorType": "not_found", "error": "not found"})
+                    return
+                self.__send_json(*handle_query_range(parameters))
+
+            def do_GET(self):
+                self.__handle(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.__handle(parse_qs(self.rfile.read(length).decode()))
+
+        return RequestHandler
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def start(self) -> str:
+        """
+        Starts serving in a background thread and returns the url of the server.
+        """
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", self.port), self.__get_request_handler_class())
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        return self.get_url()
+
+    def get_url(self) -> str:
+        assert self.http_server is not None
+        return f"http://127.0.0.1:{self.http_server.server_port}"
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+"""
+***********************************************************************************************************************
+    main function
+***********************************************************************************************************************
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic prometheus query_range data locally.")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--series", type=int, default=100)
+    parser.add_argument("--gap-probability", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    arguments = parser.parse_args()
+
+    fake_server = FakePrometheusServer(
+        number_of_series=arguments.series,
+        gap_probability=arguments.gap_probability,
+        latency_seconds=arguments.latency,
+        error_rate=arguments.error_rate,
+        port=arguments.port
+    )
+    print(f"Serving fake prometheus at {fake_server.start()}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake_server.stop()
+
+
+"""
+***********************************************************************************************************************
+    run main function
+***********************************************************************************************************************
+"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import argparse
+import datetime
+import importlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+from series_registry import SeriesRegistry
+
+# the step scripts start with a digit so they can not be imported with a plain import statement
+fetch_data = importlib.import_module("01_fetch_data")
+merge_data = importlib.import_module("02_merge_data")
+DataFetcher = fetch_data.DataFetcher
+StreamingMerger = merge_data.StreamingMerger
+DataSetMaker = importlib.import_module("03_make_dataset").DataSetMaker
+
+"""
+***********************************************************************************************************************
+    Pipeline Class
+***********************************************************************************************************************
+"""
+
+
+class Pipeline:
+    """
+    Runs the three steps as concurrent stages in one process: fetched hours go straight to the merge of their metric,
+    and every merged run of continuous hours, in parts when it is long, goes straight to the dataset maker.
+    The stages are connected by bounded queues, so a slow stage holds the ones before it back instead of piling
+    data up in memory.
+    The hourly files of step 1 and the merged files of step 2 are optional checkpoints, not the transport.
+    """
+    # put into a queue after the last item
+    END_OF_STREAM = None
+
+    def __init__(self, data_fetcher: DataFetcher, data_set_maker: DataSetMaker, windows_in_flight: int = 64,
+                 runs_in_flight: int = 2, path_to_merged_files: str = None, max_hours_of_run: int = 24):
+        self.data_fetcher = data_fetcher
+        # the fetcher gives every hour to the merge, see DataFetcher.window_consumer
+        self.data_fetcher.window_consumer = self.__give_window_to_merge
+        # a stage that fails stops the fetcher before its next query, see DataFetcher.should_stop
+        self.data_fetcher.should_stop = self.__is_stopped
+        self.data_set_maker = data_set_maker
+        # (metric, start time, end time, data frame of the hour or None)
+        self.window_queue = queue.Queue(maxsize=windows_in_flight)
+        # (metric, name of the run, merged data frame), a run can be many hours of every series
+        self.run_queue = queue.Queue(maxsize=runs_in_flight)
+        # when given every merged run is also written there, like merge_data_in_single_pass would write it
+        self.path_to_merged_files = path_to_merged_files
+        # longer runs go to the dataset maker in parts while they are still fetched, see StreamingMerger
+        self.max_hours_of_run = max_hours_of_run
+        # set when a stage fails, so that the other stages stop instead of waiting on the queues forever
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.did_failure_happen = False
+        self.statistics = {"windows": 0, "runs": 0}
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    def __is_stopped(self):
+        return self.stop_event.is_set()
+
+    def __put(self, a_queue: queue.Queue, item):
+        while not self.stop_event.is_set():
+            try:
+                a_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("the pipeline was stopped")
+
+    def __get(self, a_queue: queue.Queue):
+        while not self.stop_event.is_set():
+            try:
+                return a_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        raise RuntimeError("the pipeline was stopped")
+
+    def __run_stage(self, name_of_stage, stage_function, *arguments):
+        try:
+            stage_function(*arguments)
+        except Exception as e:
+            print(f"{name_of_stage} stage failed: {e}")
+            self.errors.append(e)
+            self.stop_event.set()
+
+    @staticmethod
+    def __get_start_and_end_of_file(file_name):
+        file_name_without_extension = os.path.splitext(file_name)[0]
+        start = datetime.datetime.strptime(file_name_without_extension[:19], "%Y-%m-%d_%H_%M_%S")
+        end = datetime.datetime.strptime(file_name_without_extension[-19:], "%Y-%m-%d_%H_%M_%S")
+        return start, end
+
+    @staticmethod
+    def __load_hourly_file(path):
+        if path.endswith(".parquet"):
+            return pandas.read_parquet(path, engine="pyarrow")
+        return pandas.read_csv(filepath_or_buffer=path, index_col=0)
+
+    def __get_hourly_files_on_disk(self, metric, windows_to_fetch, windows_of_past_hours):
+        """
+        Hours of earlier runs that were saved as files are not fetched again, they are read instead.
+        Only the hours that the fetcher would fetch are read, not every file of the metric.
+        """
+        directory = f"{self.data_fetcher.path_to_data}/{metric}"
+        if not os.path.isdir(directory):
+            return []
+        start_times_of_past_hours = {
+            start_time for _metric, start_time, _ in windows_of_past_hours if _metric == metric
+        }
+        start_times_to_fetch = {start_time for _metric, start_time, _ in windows_to_fetch if _metric == metric}
+        hourly_files = []
+        for file_name in sorted(os.listdir(directory)):
+            if not (file_name.endswith(".csv") or file_name.endswith(".parquet")):
+                continue
+            start_time, end_time = self.__get_start_and_end_of_file(file_name)
+            if start_time in start_times_of_past_hours and start_time not in start_times_to_fetch:
+                hourly_files.append((start_time, end_time, f"{directory}/{file_name}"))
+        return hourly_files
+
+    def __give_window_to_merge(self, metric, start_time, end_time, hour_df):
+        "called by the workers of the fetcher"
+        self.__put(self.window_queue, (metric, start_time, end_time, hour_df))
+
+    def __fetch(self, hourly_files_on_disk):
+        try:
+            for metric, start_time, end_time, path in hourly_files_on_disk:
+                self.__put(self.window_queue, (metric, start_time, end_time, self.__load_hourly_file(path)))
+            self.did_failure_happen = self.data_fetcher.get_metric_data_for_the_past_number_of_hours()
+        finally:
+            if not self.stop_event.is_set():
+                self.__put(self.window_queue, Pipeline.END_OF_STREAM)
+
+    def __save_merged_run(self, metric, name, merged_df):
+        path = f"{self.path_to_merged_files}/{metric}/pipeline/{name}"
+        print("Save to path = ", path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        merged_df.to_csv(path_or_buf=f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def __give_finished_runs_to_data_set_maker(self, metric, streaming_merger, is_every_window_in=False):
+        for name, merged_df in streaming_merger.pop_finished_runs(is_every_window_in=is_every_window_in):
+            print(f"merged {metric} {name}, series = {len(merged_df)}")
+            if self.path_to_merged_files is not None:
+                self.__save_merged_run(metric, name, merged_df)
+            self.__put(self.run_queue, (metric, name, merged_df))
+
+    def __merge(self, streaming_mergers):
+        while True:
+            item = self.__get(self.window_queue)
+            if item is Pipeline.END_OF_STREAM:
+                break
+            metric, start_time, end_time, hour_df = item
+            self.statistics["windows"] += 1
+            streaming_mergers[metric].append(start_time, end_time, hour_df)
+            self.__give_finished_runs_to_data_set_maker(metric, streaming_mergers[metric])
+        "windows that were expected but never came, e.g. because the hour passed, do not hold runs back any more"
+        for metric, streaming_merger in streaming_mergers.items():
+            self.__give_finished_runs_to_data_set_maker(metric, streaming_merger, is_every_window_in=True)
+        self.__put(self.run_queue, Pipeline.END_OF_STREAM)
+
+    def __make_data_sets(self):
+        while True:
+            item = self.__get(self.run_queue)
+            if item is Pipeline.END_OF_STREAM:
+                break
+            metric, name, merged_df = item
+            self.data_set_maker.make_data_set_of_data_frame(merged_df, f"{metric}_{name}")
+            self.statistics["runs"] += 1
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def run(self):
+        """
+        Fetches, merges and makes the datasets until every missing window was fetched.
+        Returns True if fetching any window failed, raises the first error of a stage.
+        """
+        windows_to_fetch = self.data_fetcher.get_windows_to_fetch()
+        windows_of_past_hours = self.data_fetcher.get_windows_of_past_number_of_hours()
+        hourly_files_on_disk = [
+            (metric, start_time, end_time, path)
+            for metric in self.data_fetcher.metrics
+            for start_time, end_time, path in self.__get_hourly_files_on_disk(
+                metric, windows_to_fetch, windows_of_past_hours
+            )
+        ]
+        print("number of windows to fetch = ", len(windows_to_fetch), ", hourly files on disk = ",
+              len(hourly_files_on_disk))
+        "a run is only merged once none of these windows can extend it any more"
+        streaming_mergers = {
+            metric: StreamingMerger(max_hours_of_part=self.max_hours_of_run) for metric in self.data_fetcher.metrics
+        }
+        for metric, start_time, end_time, *_ in windows_to_fetch + hourly_files_on_disk:
+            streaming_mergers[metric].expect([(start_time, end_time)])
+
+        start = time.time()
+        stages = [
+            threading.Thread(target=self.__run_stage, args=("fetch", self.__fetch, hourly_files_on_disk), daemon=True),
+            threading.Thread(target=self.__run_stage, args=("merge", self.__merge, streaming_mergers), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        self.__run_stage("dataset", self.__make_data_sets)
+        for stage in stages:
+            stage.join()
+        print(f"windows = {self.statistics['windows']}, runs = {self.statistics['runs']}, "
+              f"total time = {time.time() - start:.2f} seconds")
+        if self.errors:
+            raise self.errors[0]
+        return self.did_failure_happen
+
+
+"""
+***********************************************************************************************************************
+    main function
+***********************************************************************************************************************
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch, merge and make datasets in one streaming run.")
+    parser.add_argument("--url",
+                        default="https://thanos-query-frontend-opf-observatorium.apps.smaug.na.operate-first.cloud",
+                        help="prometheus to fetch from, e.g. the url of fake_prometheus_server.py")
+    parser.add_argument("--token-file", default=None, help="file that contains the access token")
+    parser.add_argument("--hours", type=int, default=24 * 10, help="number of hours to fetch backwards")
+    parser.add_argument("--max-requests-in-flight", type=int, default=8)
+    parser.add_argument("--hours-per-query", type=int, default=6)
+    parser.add_argument("--output-format", choices=["json", "binary"], default="json")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes, chunks of rows of every run are split in parallel")
+    parser.add_argument("--windows-in-flight", type=int, default=64,
+                        help="fetched hours that may wait for the merge")
+    parser.add_argument("--save-hourly-files", action="store_true",
+                        help="also write every fetched hour to data/step_1__continuous_data_fetching/, "
+                             "hours that have a file are not fetched again by the next run")
+    parser.add_argument("--series-registry", default=None,
+                        help="registry file, e.g. ../data/series_registry.csv, series are then merged by their id "
+                             "and the labels are only resolved when the datasets are written")
+    parser.add_argument("--max-hours-per-run", type=int, default=24,
+                        help="longer runs of continuous hours are merged and made into datasets in parts "
+                             "of this many hours while they are still fetched")
+    parser.add_argument("--save-merged-files", action="store_true",
+                        help="also write every merged run to data/step_2__data_islands/<metric>/pipeline/")
+    arguments = parser.parse_args()
+
+    print("""
+    This script runs the three steps at once, hours go from the fetcher to the merge
+    and merged runs go to the dataset maker while the fetcher is still fetching.
+    The datasets are written into data/step_3__data_sets/datasets/
+    """)
+
+    "the fetcher hands out new ids that the dataset maker has to resolve, so both share one registry"
+    series_registry = SeriesRegistry(arguments.series_registry or "../data/series_registry.csv")
+    data_fetcher = DataFetcher(
+        access_token=fetch_data.get_access_token(path_to_token_file=arguments.token_file),
+        url_to_fetch_from=arguments.url,
+        max_requests_in_flight=arguments.max_requests_in_flight,
+        hours_per_query=arguments.hours_per_query,
+        number_of_hours_to_fetch=arguments.hours,
+        save_windows=arguments.save_hourly_files,
+        series_registry=None if arguments.series_registry is None else series_registry
+    )
+
+    def run_pipeline(executor):
+        data_set_maker = DataSetMaker(
+            source_path="../data/step_3__data_sets/CSVs_to_turn_to_datasets/",
+            destination_path="../data/step_3__data_sets/datasets/",
+            series_registry=series_registry,
+            output_format=arguments.output_format,
+            executor=executor
+        )
+        os.makedirs(data_set_maker.destination_path, exist_ok=True)
+        pipeline = Pipeline(
+            data_fetcher=data_fetcher,
+            data_set_maker=data_set_maker,
+            windows_in_flight=arguments.windows_in_flight,
+            max_hours_of_run=arguments.max_hours_per_run,
+            path_to_merged_files="../data/step_2__data_islands" if arguments.save_merged_files else None
+        )
+        return pipeline.run()
+
+    try:
+        if arguments.workers == 1:
+            did_failure_happen = run_pipeline(executor=None)
+        else:
+            with ProcessPoolExecutor(max_workers=arguments.workers) as executor:
+                did_failure_happen = run_pipeline(executor=executor)
+    finally:
+        data_fetcher.close_connections()
+        data_fetcher.manifest.close()
+    print("Failures happened!" if did_failure_happen else "Done!")
+
+
+"""
+***********************************************************************************************************************
+    run main function
+***********************************************************************************************************************
+"""
+
+if __name__ == "__main__":
+    main()
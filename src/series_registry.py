@@ -0,0 +1,102 @@
+"""
+***********************************************************************************************************************
+    imports
+***********************************************************************************************************************
+"""
+
+import csv
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+"""
+***********************************************************************************************************************
+    Series Registry Class
+***********************************************************************************************************************
+"""
+
+
+class SeriesRegistry:
+    """
+    Global table that interns every label set (container, pod, namespace, node, ...) into a compact integer id.
+    The table is an append only csv file, so ids never change once they were handed out.
+    """
+    SERIES_ID_COLUMN = "series_id"
+
+    def __init__(self, path_to_registry: str):
+        self.path_to_registry = path_to_registry
+        # the workers of the fetcher register new series concurrently
+        self.lock = threading.Lock()
+        self.id_of_labels = {}
+        self.labels_of_id = []
+        if os.path.exists(path_to_registry):
+            self.__load()
+
+    """
+    *******************************************************************************************************************
+        Helper functions
+    *******************************************************************************************************************
+    """
+
+    @staticmethod
+    def __get_hashable_labels(labels: dict):
+        return tuple(sorted(labels.items()))
+
+    def __load(self):
+        with open(self.path_to_registry, newline="") as registry_file:
+            for series_id, labels_as_json in csv.reader(registry_file):
+                labels = json.loads(labels_as_json)
+                assert int(series_id) == len(self.labels_of_id)
+                self.id_of_labels[self.__get_hashable_labels(labels)] = int(series_id)
+                self.labels_of_id.append(labels)
+
+    def __append_to_file(self, new_rows):
+        directory = os.path.dirname(self.path_to_registry)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path_to_registry, "a", newline="") as registry_file:
+            csv.writer(registry_file).writerows(new_rows)
+
+    """
+    *******************************************************************************************************************
+        API functions
+    *******************************************************************************************************************
+    """
+
+    def get_series_ids(self, list_of_labels) -> np.ndarray:
+        """
+        Returns the id of every label set in list_of_labels, registering the label sets that are new.
+        """
+        series_ids = np.empty(len(list_of_labels), dtype=np.int64)
+        with self.lock:
+            new_rows = []
+            for i, labels in enumerate(list_of_labels):
+                hashable_labels = self.__get_hashable_labels(labels)
+                series_id = self.id_of_labels.get(hashable_labels)
+                if series_id is None:
+                    series_id = len(self.labels_of_id)
+                    self.id_of_labels[hashable_labels] = series_id
+                    self.labels_of_id.append(dict(labels))
+                    new_rows.append((series_id, json.dumps(labels)))
+                series_ids[i] = series_id
+            if new_rows:
+                self.__append_to_file(new_rows)
+        return series_ids
+
+    def get_labels(self, series_id: int) -> dict:
+        with self.lock:
+            return self.labels_of_id[series_id]
+
+    def get_key(self, series_id: int) -> str:
+        """
+        Returns the same key that is built from label columns, e.g. 'container, namespace, node, pod' values.
+        """
+        return ', '.join(self.get_labels(series_id).values())
+
+    def get_labels_data_frame(self, series_ids) -> pd.DataFrame:
+        """
+        Resolves ids back to label columns, this is only needed when exporting.
+        """
+        return pd.DataFrame([self.get_labels(int(series_id)) for series_id in series_ids])
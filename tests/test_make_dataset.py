@@ -0,0 +1,88 @@
+import filecmp
+import importlib
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+DataSetMaker = importlib.import_module("03_make_dataset").DataSetMaker
+
+
+def write_merged_csv(path, number_of_rows=2000, number_of_minutes=60):
+    "the container label is empty and the pod label looks like a number in the rows of the first blocks"
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(number_of_rows, number_of_minutes))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    time_stamps = pd.date_range("2022-01-01", periods=number_of_minutes, freq="min").strftime("%Y-%m-%d_%H_%M_%S")
+    df = pd.DataFrame(values, columns=time_stamps)
+    df.insert(0, "pod", [str(i) if i < number_of_rows // 2 else f"pod-{i}" for i in range(number_of_rows)])
+    df.insert(0, "container", [None if i < number_of_rows // 2 else f"container-{i % 7}" for i in range(number_of_rows)])
+    df.insert(0, "__name__", "cpu")
+    df.to_csv(path)
+
+
+def make_data_set(source_path, destination_path, fast_csv_reading):
+    os.makedirs(destination_path)
+    DataSetMaker(
+        source_path=f"{source_path}/",
+        destination_path=f"{destination_path}/",
+        output_format="binary",
+        fast_csv_reading=fast_csv_reading
+    ).make_data_sets_and_save_them()
+    return f"{destination_path}/merged.dataset"
+
+
+def test_fast_csv_reading_with_a_label_that_is_empty_in_the_first_block(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "merged")
+    write_merged_csv(tmp_path / "merged" / "merged.csv")
+    "blocks of 64 KB, the first ones only have empty containers"
+    monkeypatch.setattr(DataSetMaker, "FAST_CSV_BLOCK_SIZE", 1 << 16)
+    fast_data_set = make_data_set(tmp_path / "merged", tmp_path / "fast", fast_csv_reading=True)
+    default_data_set = make_data_set(tmp_path / "merged", tmp_path / "default", fast_csv_reading=False)
+    "binary datasets are float32 in both paths, so they are the same"
+    for file_name in os.listdir(default_data_set):
+        assert filecmp.cmp(f"{fast_data_set}/{file_name}", f"{default_data_set}/{file_name}", shallow=False)
+
+
+def write_hourly_files(directory, number_of_hours=5, number_of_rows=300):
+    "the pod label looks like a number, some rows are almost empty and the minutes of the last hour are missing"
+    rng = np.random.default_rng(1)
+    start = pd.Timestamp("2022-01-01 00:00:00")
+    for hour in range(number_of_hours):
+        end = start + pd.Timedelta(hours=1)
+        time_stamps = pd.date_range(start, end, freq="min").strftime("%Y-%m-%d_%H_%M_%S")
+        values = rng.normal(size=(number_of_rows, len(time_stamps)))
+        values[rng.random(values.shape) < 0.2] = np.nan
+        values[::50] = np.nan
+        if hour == number_of_hours - 1:
+            values[:, -10:] = np.nan
+        df = pd.DataFrame(values, columns=time_stamps)
+        df.insert(0, "pod", [str(i) for i in range(number_of_rows)])
+        df.insert(0, "__name__", "cpu")
+        df.to_csv(f"{directory}/{start:%Y-%m-%d_%H_%M_%S}_to_{end:%Y-%m-%d_%H_%M_%S}.csv")
+        start = end
+
+
+def test_memory_mapped_merge_makes_the_same_data_set_as_the_merged_csv(tmp_path, monkeypatch):
+    DataMerger = importlib.import_module("02_merge_data").DataMerger
+    path_to_data = tmp_path / "step_1" / "cpu"
+    os.makedirs(path_to_data)
+    os.makedirs(tmp_path / "src")
+    monkeypatch.chdir(tmp_path / "src")
+    write_hourly_files(path_to_data)
+    single_pass_path, = DataMerger(str(path_to_data)).merge_data_in_single_pass()
+    matrix_path, = DataMerger(str(path_to_data)).merge_data_out_of_core(memory_limit_in_bytes=1 << 16)
+    os.makedirs(tmp_path / "merged")
+    os.makedirs(tmp_path / "out_of_core")
+    shutil.copy(single_pass_path, tmp_path / "merged" / "merged.csv")
+    for extension in [".f32", ".json", ".labels.csv"]:
+        shutil.copy(f"{os.path.splitext(matrix_path)[0]}{extension}", tmp_path / "out_of_core" / f"merged{extension}")
+    monkeypatch.setattr(DataSetMaker, "MEMORY_MAPPED_ROWS_PER_BLOCK", 64)
+    out_of_core_data_set = make_data_set(tmp_path / "out_of_core", tmp_path / "from_matrix", fast_csv_reading=False)
+    csv_data_set = make_data_set(tmp_path / "merged", tmp_path / "from_csv", fast_csv_reading=True)
+    "the json and the labels next to the matrix are not read as merged files"
+    assert sorted(os.listdir(tmp_path / "from_matrix")) == sorted(os.listdir(tmp_path / "from_csv"))
+    for file_name in os.listdir(csv_data_set):
+        assert filecmp.cmp(f"{out_of_core_data_set}/{file_name}", f"{csv_data_set}/{file_name}", shallow=False)
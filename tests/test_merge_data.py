@@ -0,0 +1,63 @@
+import importlib
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+DataMerger = importlib.import_module("02_merge_data").DataMerger
+
+
+def write_hourly_file(directory, start, labels_of_rows):
+    "labels_of_rows is a list of dictionaries of labels, every hour has 61 minutes like the fetched files"
+    end = start + pd.Timedelta(hours=1)
+    time_stamps = pd.date_range(start, end, freq="min").strftime("%Y-%m-%d_%H_%M_%S")
+    values = np.arange(len(labels_of_rows) * len(time_stamps), dtype=np.float64).reshape(len(labels_of_rows), -1)
+    df = pd.concat([pd.DataFrame(labels_of_rows), pd.DataFrame(values + start.hour * 1000, columns=time_stamps)], axis=1)
+    df.to_csv(f"{directory}/{start:%Y-%m-%d_%H_%M_%S}_to_{end:%Y-%m-%d_%H_%M_%S}.csv")
+
+
+def make_hourly_files_with_a_new_label(tmp_path, monkeypatch):
+    "the second hour adds a zone label, the third one has the labels in another order"
+    path_to_data = tmp_path / "step_1" / "cpu"
+    os.makedirs(path_to_data)
+    os.makedirs(tmp_path / "src")
+    monkeypatch.chdir(tmp_path / "src")
+    start = pd.Timestamp("2022-01-01 00:00:00")
+    write_hourly_file(path_to_data, start, [{"pod": "a"}, {"pod": "b"}])
+    write_hourly_file(path_to_data, start + pd.Timedelta(hours=1), [{"pod": "a", "zone": "z1"}, {"pod": "b"}])
+    write_hourly_file(
+        path_to_data, start + pd.Timedelta(hours=2), [{"zone": "z1", "pod": "a"}, {"zone": None, "pod": "c"}]
+    )
+    return str(path_to_data)
+
+
+def get_values_of_series(merged_df):
+    label_columns = [column for column in merged_df.columns if not column[:1].isdigit()]
+    merged_df[label_columns] = merged_df[label_columns].fillna("")
+    merged_df = merged_df.set_index(label_columns)
+    return {labels: row.dropna().tolist() for labels, row in merged_df.iterrows()}
+
+
+def test_merges_with_a_label_that_only_some_hours_have(tmp_path, monkeypatch):
+    path_to_data = make_hourly_files_with_a_new_label(tmp_path, monkeypatch)
+    DataMerger(path_to_data).merge_data()
+    iteration_directory = tmp_path / "data" / "step_2__data_islands" / "cpu" / "iteration_2"
+    pairwise_path, = [f"{iteration_directory}/{name}" for name in os.listdir(iteration_directory)]
+    pairwise_df = pd.read_csv(pairwise_path, index_col=0)
+    assert list(pairwise_df.columns[:2]) == ["pod", "zone"]
+    values_of_series = get_values_of_series(pairwise_df)
+    assert set(values_of_series) == {("a", ""), ("b", ""), ("a", "z1"), ("c", "")}
+    "the last minute of every hour but the last is dropped"
+    assert sum(len(values) for values in values_of_series.values()) == 2 * 60 + 2 * 60 + 2 * 61
+
+    single_pass_path, = DataMerger(path_to_data).merge_data_in_single_pass()
+    single_pass_df = pd.read_csv(single_pass_path, index_col=0)
+    assert list(single_pass_df.columns[:2]) == ["pod", "zone"]
+    assert get_values_of_series(single_pass_df) == values_of_series
+
+    "the merged store gets the hours one by one, the zone label is added after the first one"
+    DataMerger(path_to_data).append_new_files_to_live_segments()
+    live_directory = tmp_path / "data" / "step_2__data_islands" / "cpu" / "live"
+    live_path, = [f"{live_directory}/{name}" for name in os.listdir(live_directory) if name != "segments.csv"]
+    assert get_values_of_series(pd.read_csv(live_path, index_col=0)) == values_of_series
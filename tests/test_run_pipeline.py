@@ -0,0 +1,30 @@
+import importlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from fake_prometheus_server import FakePrometheusServer
+run_pipeline = importlib.import_module("run_pipeline")
+
+
+def test_a_failing_stage_stops_the_fetcher(tmp_path):
+    server = FakePrometheusServer(number_of_series=20, gap_probability=0.0)
+    server.start()
+    try:
+        data_fetcher = run_pipeline.DataFetcher(
+            "token", server.get_url(), max_requests_in_flight=4, hours_per_query=1,
+            path_to_data=str(tmp_path / "step_1"), number_of_hours_to_fetch=48, save_windows=False
+        )
+        data_set_maker = run_pipeline.DataSetMaker(f"{tmp_path}/merged/", f"{tmp_path}/datasets/")
+
+        def fail(df, csv_file):
+            raise ValueError("the dataset stage failed")
+        data_set_maker.make_data_set_of_data_frame = fail
+        pipeline = run_pipeline.Pipeline(data_fetcher, data_set_maker, max_hours_of_run=2)
+        with pytest.raises(ValueError):
+            pipeline.run()
+        "48 hours of 3 metrics are 144 queries, only the ones in flight when the stage failed are finished"
+        assert data_fetcher.statistics["queries"] < 144 // 2
+    finally:
+        server.stop()